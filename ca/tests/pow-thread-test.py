@@ -0,0 +1,97 @@
+# $Id$
+#
+# Copyright (C) 2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Smoke test for POW methods which release the GIL: hammer the same
+certificates and CRL from several threads at once, along with key
+generation, and check that every call still gets the right answer.
+This matters most with OpenSSL releases before 1.1.0, which rely on
+the locking callbacks POW installs at import time.
+"""
+
+import sys
+import argparse
+import threading
+
+import rpki.POW
+import rpki.x509
+import rpki.sundial
+
+parser = argparse.ArgumentParser(description = __doc__)
+parser.add_argument("--threads", type = int, default = 8)
+parser.add_argument("--iterations", type = int, default = 200)
+args = parser.parse_args()
+
+now = rpki.sundial.now()
+notAfter = now + rpki.sundial.timedelta(days = 1)
+
+ca_key = rpki.x509.RSA.generate(quiet = True)
+ca_cer = rpki.x509.X509.bpki_self_certify(
+    keypair      = ca_key,
+    subject_name = rpki.x509.X501DN.from_cn("POW thread test CA"),
+    serial       = 1,
+    now          = now,
+    notAfter     = notAfter)
+
+ee_key = rpki.x509.RSA.generate(quiet = True)
+ee_cer = ca_cer.bpki_certify(
+    keypair      = ca_key,
+    subject_name = rpki.x509.X501DN.from_cn("POW thread test EE"),
+    subject_key  = ee_key.get_public(),
+    serial       = 2,
+    now          = now,
+    notAfter     = notAfter,
+    is_ca        = False)
+
+crl = rpki.x509.CRL.generate(
+    keypair             = ca_key,
+    issuer              = ca_cer,
+    serial              = 1,
+    thisUpdate          = now,
+    nextUpdate          = notAfter,
+    revokedCertificates = ())
+
+failures = []
+
+def worker(n):
+    try:
+        for i in xrange(args.iterations):
+            ee_cer.get_POW().verify(trusted = (ca_cer.get_POW(),), crl = crl.get_POW())
+            ca_cer.get_POW().verify(trusted = (ca_cer.get_POW(),))
+            crl.get_POW().verify(ca_cer.get_POW())
+            try:
+                crl.get_POW().verify(ee_cer.get_POW())
+            except rpki.POW.ValidationError:
+                pass
+            else:
+                raise RuntimeError("CRL verified against the wrong key")
+            if i % 50 == 0:
+                rpki.POW.Asymmetric.generateRSA(1024)
+    except Exception as e:
+        failures.append((n, e))
+
+threads = [threading.Thread(target = worker, args = (n,)) for n in xrange(args.threads)]
+
+for t in threads:
+    t.start()
+
+for t in threads:
+    t.join()
+
+for n, e in failures:
+    print "Thread %d failed: %r" % (n, e)
+
+sys.exit(1 if failures else 0)
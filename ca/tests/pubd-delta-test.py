@@ -0,0 +1,140 @@
+# $Id$
+#
+# Copyright (C) 2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Round-trip tests for pubd's RRDP deltas: PDUs are validated one at a
+time as they're added and streamed out by activate(), so check that
+what lands on disk is a valid delta containing exactly the changes we
+made, in order, with the hash we recorded, and that a bad PDU is
+rejected without touching the delta.
+"""
+
+import os
+import uuid
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import django
+import lxml.etree
+
+from django.conf import settings
+
+settings.configure(
+    DATABASES = dict(default = dict(ENGINE = "django.db.backends.sqlite3", NAME = ":memory:")),
+    INSTALLED_APPS = ["rpki.pubdb"])
+
+django.setup()
+
+from django.core.management import call_command
+
+import rpki.x509
+import rpki.sundial
+import rpki.relaxng
+import rpki.pubdb.models
+
+from rpki.pubdb.models import Session, Client, rrdp_tag_publish, rrdp_tag_withdraw
+
+
+class PubdDeltaTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        call_command("migrate", verbosity = 0, interactive = False)
+        now = rpki.sundial.now()
+        key = rpki.x509.RSA.generate(quiet = True)
+        cls.bpki_cert = rpki.x509.X509.bpki_self_certify(
+            keypair      = key,
+            subject_name = rpki.x509.X501DN.from_cn("pubd delta test"),
+            serial       = 1,
+            now          = now,
+            notAfter     = now + rpki.sundial.timedelta(days = 1))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.session = Session.objects.create(uuid = str(uuid.uuid4()), serial = 0)
+        self.client = Client.objects.create(client_handle = "client-%s" % self.session.uuid,
+                                            base_uri = "rsync://example.org/test/",
+                                            bpki_cert = self.bpki_cert)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_delta(self):
+        return self.session.new_delta(rpki.sundial.now() + rpki.sundial.timedelta(hours = 1))
+
+    def activate(self, delta):
+        """
+        Write out a delta and check the result against the schema and
+        the hash we recorded.  Returns (tag, uri, hash, der) for each PDU.
+        """
+
+        delta.flush()
+        delta.activate(self.tmpdir)
+        with open(os.path.join(self.tmpdir, delta.fn), "rb") as f:
+            data = f.read()
+        self.assertEqual(delta.hash, hashlib.sha256(data).hexdigest())
+        root = lxml.etree.fromstring(data)
+        rpki.relaxng.rrdp.assertValid(root)
+        self.assertEqual(root.get("session_id"), self.session.uuid)
+        self.assertEqual(long(root.get("serial")), delta.serial)
+        return [(pdu.tag, pdu.get("uri"), pdu.get("hash"),
+                 pdu.text.decode("base64") if pdu.tag == rrdp_tag_publish else None)
+                for pdu in root]
+
+    def test_publish_and_withdraw(self):
+        objects = [("rsync://example.org/test/%d.cer" % i, os.urandom(100 + i)) for i in xrange(20)]
+
+        delta = self.new_delta()
+        for uri, der in objects:
+            delta.publish(self.client, der, uri, None)
+        self.assertEqual(self.activate(delta),
+                         [(rrdp_tag_publish, uri, None, der) for uri, der in objects])
+
+        def sha256(der):
+            return hashlib.sha256(der).hexdigest()
+
+        replacement = os.urandom(200)
+        delta = self.new_delta()
+        expected = []
+        for uri, der in objects[:5]:
+            delta.withdraw(self.client, uri, sha256(der))
+            expected.append((rrdp_tag_withdraw, uri, sha256(der), None))
+        uri, der = objects[5]
+        delta.publish(self.client, replacement, uri, sha256(der))
+        expected.append((rrdp_tag_publish, uri, sha256(der), replacement))
+        self.assertEqual(self.activate(delta), expected)
+
+        self.assertEqual(
+            sorted(self.client.publishedobject_set.values_list("uri", "hash")),
+            sorted([(uri, sha256(der)) for uri, der in objects[6:]] + [(objects[5][0], sha256(replacement))]))
+
+    def test_bad_pdu(self):
+        delta = self.new_delta()
+        delta.publish(self.client, os.urandom(100), "rsync://example.org/test/good.cer", None)
+        savepoint = delta.savepoint()
+        with self.assertRaises(lxml.etree.DocumentInvalid):
+            delta.publish(self.client, os.urandom(100), "rsync://example.org/test/bad.cer", "not-a-hash")
+        self.assertEqual(delta.savepoint(), savepoint)
+        self.assertEqual(len(delta.xml), savepoint)
+        delta.rollback(savepoint)
+        self.assertEqual([uri for tag, uri, hash, der in self.activate(delta)],
+                         ["rsync://example.org/test/good.cer"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+# $Id$
+#
+# Copyright (C) 2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Round-trip tests for the rpki-rtr generator: the packed AXFR and IXFR
+code used by the cronjob must write exactly the same files as the
+original PDU object code, and composing consecutive IXFRs must give
+the same result as diffing the AXFRs at either end.
+"""
+
+import os
+import base64
+import random
+import shutil
+import tempfile
+import unittest
+
+import rpki.rtr.pdus
+import rpki.rtr.generator
+
+from rpki.rtr.channels import Timestamp
+from rpki.rtr.generator import (PrefixPDU, RouterKeyPDU, AXFRSet, IXFRSet,
+                                PackedAXFRSet, PackedIXFRSet)
+
+
+class RTRGeneratorTest(unittest.TestCase):
+
+    versions = sorted(rpki.rtr.pdus.PDU.version_map)
+
+    def setUp(self):
+        self.random = random.Random(42)
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        self.serial = 1000
+
+        # A universe of PDU texts to draw sets from.  Router keys only
+        # exist in protocol versions that have them.
+
+        self.prefixes = [("%d" % (64496 + i % 7), "10.%d.0.0/16-%d" % (i, 16 + i % 9)) for i in xrange(60)]
+        self.prefixes.extend(("%d" % (64496 + i % 5), "2001:db8:%x::/48" % i) for i in xrange(40))
+        self.routerkeys = [("%d" % (64496 + i % 3),
+                            base64.urlsafe_b64encode(self.random_bytes(20)).rstrip("="),
+                            base64.b64encode(self.random_bytes(91)))
+                           for i in xrange(20)]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def random_bytes(self, n):
+        return "".join(chr(self.random.getrandbits(8)) for i in xrange(n))
+
+    def chdir(self, name):
+        dn = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(dn):
+            os.makedirs(dn)
+        os.chdir(dn)
+
+    def pick(self, version):
+        """
+        Pick a random set of PDU texts, with a few duplicates.
+        """
+
+        prefixes = self.random.sample(self.prefixes, len(self.prefixes) // 2)
+        prefixes.extend(prefixes[:3])
+        routerkeys = []
+        if RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]:
+            routerkeys = self.random.sample(self.routerkeys, len(self.routerkeys) // 2)
+            routerkeys.extend(routerkeys[:2])
+        return prefixes, routerkeys
+
+    def pdus(self, version, texts):
+        prefixes, routerkeys = texts
+        for asn, addr in prefixes:
+            yield PrefixPDU.from_text(version = version, asn = asn, addr = addr)
+        for asn, gski, key in routerkeys:
+            yield RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
+
+    def make_axfrs(self, version, texts):
+        """
+        Build the same AXFR both ways, the way the parse_rcynic() methods do.
+        """
+
+        self.serial += 1
+
+        old = AXFRSet(version = version)
+        old.serial = Timestamp(self.serial)
+        old.extend(self.pdus(version, texts))
+        old.sort()
+        for i in xrange(len(old) - 2, -1, -1):
+            if old[i] == old[i + 1]:
+                del old[i + 1]
+
+        new = PackedAXFRSet(version = version)
+        new.serial = Timestamp(self.serial)
+        new.extend(set(pdu.to_pdu() for pdu in self.pdus(version, texts)))
+        new.sort()
+
+        return old, new
+
+    @staticmethod
+    def read(fn):
+        with open(fn, "rb") as f:
+            return f.read()
+
+    def test_axfr(self):
+        for version in self.versions:
+            old, new = self.make_axfrs(version, self.pick(version))
+            self.assertEqual([pdu.to_pdu() for pdu in old], list(new))
+            self.chdir("old")
+            old.save_axfr()
+            old_data = self.read(old.filename())
+            self.chdir("new")
+            new.save_axfr()
+            self.assertEqual(old_data, self.read(new.filename()))
+            self.assertEqual(PackedAXFRSet.load(new.filename()), new)
+            self.assertEqual([pdu.to_pdu() for pdu in AXFRSet.load(new.filename())], list(new))
+
+    def test_ixfr(self):
+        for version in self.versions:
+            old_a, new_a = self.make_axfrs(version, self.pick(version))
+            old_b, new_b = self.make_axfrs(version, self.pick(version))
+            self.chdir("old")
+            old_b.save_ixfr(old_a)
+            self.chdir("new")
+            ixfr = new_b.save_ixfr(new_a)
+            fn = ixfr.filename()
+            self.assertEqual(self.read(os.path.join(self.tmpdir, "old", fn)), self.read(fn))
+            self.assertEqual(PackedIXFRSet.load(fn), ixfr)
+            self.assertEqual([pdu.to_pdu() for pdu in IXFRSet.load(fn)], list(ixfr))
+
+    def test_ixfr_identical(self):
+        for version in self.versions:
+            texts = self.pick(version)
+            old_a, new_a = self.make_axfrs(version, texts)
+            old_b, new_b = self.make_axfrs(version, texts)
+            self.chdir("new")
+            ixfr = new_b.save_ixfr(new_a)
+            self.assertEqual(list(ixfr), [])
+            self.assertEqual(PackedIXFRSet.load(ixfr.filename()), ixfr)
+
+    def test_compose(self):
+        for version in self.versions:
+            axfrs = [self.make_axfrs(version, self.pick(version))[1] for i in xrange(5)]
+            ixfrs = [axfrs[i + 1].diff(axfrs[i]) for i in xrange(len(axfrs) - 1)]
+            for i in xrange(len(ixfrs)):
+                composed = ixfrs[i]
+                for j in xrange(i + 1, len(ixfrs)):
+                    composed = composed.compose(ixfrs[j])
+                    direct = axfrs[j + 1].diff(axfrs[i])
+                    self.assertEqual(composed.from_serial, direct.from_serial)
+                    self.assertEqual(composed.to_serial, direct.to_serial)
+                    self.assertEqual(list(composed), list(direct))
+
+    def test_compose_cancels(self):
+        for version in self.versions:
+            texts = self.pick(version)
+            a = self.make_axfrs(version, texts)[1]
+            b = self.make_axfrs(version, self.pick(version))[1]
+            c = self.make_axfrs(version, texts)[1]
+            self.assertEqual(list(b.diff(a).compose(c.diff(b))), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -71,6 +71,7 @@
 #define	PY_SSIZE_T_CLEAN 1
 #include <Python.h>
 #include <datetime.h>
+#include <pythread.h>
 
 #include <openssl/opensslconf.h>
 #include <openssl/crypto.h>
@@ -346,6 +347,7 @@ typedef struct {
 typedef struct {
   PyObject_HEAD
   X509 *x509;
+  PyThread_type_lock lock;
 } x509_object;
 
 typedef struct {
@@ -357,6 +359,7 @@ typedef struct {
 typedef struct {
   PyObject_HEAD
   X509_CRL *crl;
+  PyThread_type_lock lock;
 } crl_object;
 
 typedef struct {
@@ -378,6 +381,7 @@ typedef struct {
 typedef struct {
   PyObject_HEAD
   CMS_ContentInfo *cms;
+  PyThread_type_lock lock;
 } cms_object;
 
 typedef struct {
@@ -394,6 +398,7 @@ typedef struct {
   PyObject_HEAD
   X509_REQ *pkcs10;
   X509_EXTENSIONS *exts;
+  PyThread_type_lock lock;
 } pkcs10_object;
 
 /*
@@ -770,6 +775,57 @@ x509_helper_iterable_to_stack(PyObject *iterable)
   return NULL;
 }
 
+/*
+ * Some methods release the GIL while OpenSSL works on objects that
+ * other threads can see, and OpenSSL caches things inside those
+ * objects as it goes, so these calls are serialized on a per-object
+ * lock, created the first time the object needs it.  The lock is
+ * only ever taken with the GIL released, and only one at a time, so
+ * it can't deadlock against the GIL or against another object's lock.
+ * This means one thread's callbacks must not call back into a locked
+ * method on the same object.
+ */
+
+static int
+object_lock_init(PyThread_type_lock *lock)
+{
+  if (*lock == NULL && (*lock = PyThread_allocate_lock()) == NULL) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  return 1;
+}
+
+static void
+object_lock_free(PyThread_type_lock lock)
+{
+  if (lock != NULL)
+    PyThread_free_lock(lock);
+}
+
+#define BEGIN_ALLOW_THREADS_LOCKED(_lock_)      \
+  Py_BEGIN_ALLOW_THREADS;                       \
+  PyThread_acquire_lock(_lock_, WAIT_LOCK)
+
+#define END_ALLOW_THREADS_LOCKED(_lock_)        \
+  PyThread_release_lock(_lock_);                \
+  Py_END_ALLOW_THREADS
+
+/*
+ * Certificates we don't lock, such as the other members of a chain,
+ * are only read, once OpenSSL has cached their extensions, which we
+ * make it do while we still hold the GIL.
+ */
+
+static void
+x509_helper_cache_extensions(STACK_OF(X509) *stack)
+{
+  int i;
+
+  for (i = 0; i < sk_X509_num(stack); i++)
+    (void) X509_check_purpose(sk_X509_value(stack, i), -1, 0);
+}
+
 /*
  * Pull items off an OpenSSL STACK and put them into a Python tuple.
  * Assumes that handler is stealing the OpenSSL references to the
@@ -2853,6 +2909,7 @@ x509_object_dealloc(x509_object *self)
 {
   ENTERING(x509_object_dealloc);
   X509_free(self->x509);
+  object_lock_free(self->lock);
   self->ob_type->tp_free((PyObject*) self);
 }
 
@@ -3142,6 +3199,9 @@ x509_object_verify(x509_object *self, PyObject *args, PyObject *kwds)
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OOOOO", kwlist, &trusted, &untrusted, &crl, &policy, &ctxclass))
     goto error;
 
+  if (!object_lock_init(&self->lock))
+    goto error;
+
   if ((trusted_stack = x509_helper_iterable_to_stack(trusted)) == NULL)
     goto error;
 
@@ -3195,7 +3255,12 @@ x509_object_verify(x509_object *self, PyObject *args, PyObject *kwds)
   X509_STORE_CTX_set_verify_cb(ctx->ctx, x509_store_ctx_object_verify_cb);
   X509_VERIFY_PARAM_set_flags(ctx->ctx->param, X509_V_FLAG_X509_STRICT);
 
+  x509_helper_cache_extensions(trusted_stack);
+  x509_helper_cache_extensions(untrusted_stack);
+
+  BEGIN_ALLOW_THREADS_LOCKED(self->lock);
   ok = X509_verify_cert(ctx->ctx) >= 0;
+  END_ALLOW_THREADS_LOCKED(self->lock);
 
   X509_STORE_CTX_set0_crls(ctx->ctx, NULL);
   X509_STORE_CTX_set_chain(ctx->ctx, NULL);
@@ -4882,18 +4947,31 @@ x509_store_ctx_object_verify_cb(int ok, X509_STORE_CTX *ctx)
   static char method_name[] = "verify_callback";
   x509_store_ctx_object *self = (x509_store_ctx_object *) X509_STORE_CTX_get_ex_data(ctx, x509_store_ctx_ex_data_idx);
   PyObject *result = NULL;
+  PyGILState_STATE gil;
 
   if (self == NULL)
     return ok;
 
+  /*
+   * X509_verify_cert() runs without the GIL, so we have to get it back
+   * before touching any Python objects.
+   */
+
+  gil = PyGILState_Ensure();
+
   if (!PyObject_HasAttrString((PyObject *) self, method_name))
-    return ok;
+    goto done;
 
-  if ((result = PyObject_CallMethod((PyObject *) self, method_name, "i", ok)) == NULL)
-    return -1;
+  if ((result = PyObject_CallMethod((PyObject *) self, method_name, "i", ok)) == NULL) {
+    ok = -1;
+    goto done;
+  }
 
   ok = PyObject_IsTrue(result);
   Py_XDECREF(result);
+
+ done:
+  PyGILState_Release(gil);
   return ok;
 }
 
@@ -5150,6 +5228,7 @@ crl_object_dealloc(crl_object *self)
 {
   ENTERING(crl_object_dealloc);
   X509_CRL_free(self->crl);
+  object_lock_free(self->lock);
   self->ob_type->tp_free((PyObject*) self);
 }
 
@@ -5672,18 +5751,32 @@ static PyObject *
 crl_object_verify(crl_object *self, PyObject *args)
 {
   x509_object *issuer;
+  EVP_PKEY *pkey = NULL;
+  int ok;
 
   ENTERING(crl_object_verify);
 
   if (!PyArg_ParseTuple(args, "O!", &POW_X509_Type, &issuer))
     goto error;
 
-  if (!X509_CRL_verify(self->crl, X509_get_pubkey(issuer->x509)))
+  if (!object_lock_init(&self->lock))
+    goto error;
+
+  if ((pkey = X509_get_pubkey(issuer->x509)) == NULL)
+    lose_openssl_error("Couldn't extract public key from issuer certificate");
+
+  BEGIN_ALLOW_THREADS_LOCKED(self->lock);
+  ok = X509_CRL_verify(self->crl, pkey) > 0;
+  END_ALLOW_THREADS_LOCKED(self->lock);
+
+  if (!ok)
     lose_validation_error("X509_CRL_verify() raised an exception");
 
+  EVP_PKEY_free(pkey);
   Py_RETURN_NONE;
 
  error:
+  EVP_PKEY_free(pkey);
   return NULL;
 }
 
@@ -6354,7 +6447,7 @@ asymmetric_object_generate_rsa(PyTypeObject *type, PyObject *args, PyObject *kwd
   asymmetric_object *self = NULL;
   EVP_PKEY_CTX *ctx = NULL;
   int key_size = 2048;
-  int ok = 0;
+  int generated, ok = 0;
 
   ENTERING(asymmetric_object_generate_rsa);
 
@@ -6372,10 +6465,14 @@ asymmetric_object_generate_rsa(PyTypeObject *type, PyObject *args, PyObject *kwd
    * BN_free().
    */
 
-  if ((ctx = EVP_PKEY_CTX_new_id(EVP_PKEY_RSA, NULL)) == NULL ||
-      EVP_PKEY_keygen_init(ctx) <= 0 ||
-      EVP_PKEY_CTX_set_rsa_keygen_bits(ctx, key_size) <= 0 ||
-      EVP_PKEY_keygen(ctx, &self->pkey) <= 0)
+  Py_BEGIN_ALLOW_THREADS;
+  generated = ((ctx = EVP_PKEY_CTX_new_id(EVP_PKEY_RSA, NULL)) != NULL &&
+        EVP_PKEY_keygen_init(ctx) > 0 &&
+        EVP_PKEY_CTX_set_rsa_keygen_bits(ctx, key_size) > 0 &&
+        EVP_PKEY_keygen(ctx, &self->pkey) > 0);
+  Py_END_ALLOW_THREADS;
+
+  if (!generated)
     lose_openssl_error("Couldn't generate new RSA key");
 
   ok = 1;
@@ -6400,7 +6497,7 @@ asymmetric_object_generate_from_params(PyTypeObject *type, PyObject *args)
   asymmetric_params_object *params = NULL;
   asymmetric_object *self = NULL;
   EVP_PKEY_CTX *ctx = NULL;
-  int ok = 0;
+  int generated, ok = 0;
 
   ENTERING(asymmetric_object_generate_from_params);
 
@@ -6410,9 +6507,13 @@ asymmetric_object_generate_from_params(PyTypeObject *type, PyObject *args)
   if ((self = (asymmetric_object *) asymmetric_object_new(type, NULL, NULL)) == NULL)
     goto error;
 
-  if ((ctx = EVP_PKEY_CTX_new(params->pkey, NULL)) == NULL ||
-      EVP_PKEY_keygen_init(ctx) <= 0 ||
-      EVP_PKEY_keygen(ctx, &self->pkey) <= 0)
+  Py_BEGIN_ALLOW_THREADS;
+  generated = ((ctx = EVP_PKEY_CTX_new(params->pkey, NULL)) != NULL &&
+        EVP_PKEY_keygen_init(ctx) > 0 &&
+        EVP_PKEY_keygen(ctx, &self->pkey) > 0);
+  Py_END_ALLOW_THREADS;
+
+  if (!generated)
     lose_openssl_error("Couldn't generate new key");
 
   whack_ec_key_to_namedCurve(self->pkey);
@@ -7060,6 +7161,7 @@ cms_object_dealloc(cms_object *self)
 {
   ENTERING(cms_object_dealloc);
   CMS_ContentInfo_free(self->cms);
+  object_lock_free(self->lock);
   self->ob_type->tp_free((PyObject*) self);
 }
 
@@ -7212,7 +7314,7 @@ cms_object_sign_helper(cms_object *self,
   CMS_ContentInfo *cms = NULL;
   PyObject *iterator = NULL;
   PyObject *item = NULL;
-  int ok = 0;
+  int finalized, ok = 0;
 
   ENTERING(cms_object_sign_helper);
 
@@ -7266,7 +7368,11 @@ cms_object_sign_helper(cms_object *self,
     }
   }
 
-  if (!CMS_final(cms, bio, NULL, flags))
+  Py_BEGIN_ALLOW_THREADS;
+  finalized = CMS_final(cms, bio, NULL, flags);
+  Py_END_ALLOW_THREADS;
+
+  if (!finalized)
     lose_openssl_error("Couldn't finalize CMS signatures");
 
   assert_no_unhandled_openssl_errors();
@@ -7414,6 +7520,7 @@ cms_object_verify_helper(cms_object *self, PyObject *args, PyObject *kwds)
   PyObject *certs_iterable = Py_None;
   STACK_OF(X509) *certs_stack = NULL;
   unsigned flags = 0, ok = 0;
+  int verified;
   BIO *bio = NULL;
 
   const unsigned flag_mask =
@@ -7441,7 +7548,16 @@ cms_object_verify_helper(cms_object *self, PyObject *args, PyObject *kwds)
 
   assert_no_unhandled_openssl_errors();
 
-  if (CMS_verify(self->cms, certs_stack, NULL, NULL, bio, flags) <= 0)
+  if (!object_lock_init(&self->lock))
+    goto error;
+
+  x509_helper_cache_extensions(certs_stack);
+
+  BEGIN_ALLOW_THREADS_LOCKED(self->lock);
+  verified = CMS_verify(self->cms, certs_stack, NULL, NULL, bio, flags) > 0;
+  END_ALLOW_THREADS_LOCKED(self->lock);
+
+  if (!verified)
     lose_openssl_error("Couldn't verify CMS message");
 
   assert_no_unhandled_openssl_errors();
@@ -9169,6 +9285,7 @@ pkcs10_object_dealloc(pkcs10_object *self)
   ENTERING(pkcs10_object_dealloc);
   X509_REQ_free(self->pkcs10);
   sk_X509_EXTENSION_pop_free(self->exts, X509_EXTENSION_free);
+  object_lock_free(self->lock);
   self->ob_type->tp_free((PyObject*) self);
 }
 
@@ -9475,7 +9592,14 @@ pkcs10_object_verify(pkcs10_object *self)
   if ((pkey = X509_REQ_get_pubkey(self->pkcs10)) == NULL)
     lose_openssl_error("Couldn't extract public key from PKCS#10 for verification");
 
-  if ((status = X509_REQ_verify(self->pkcs10, pkey)) < 0)
+  if (!object_lock_init(&self->lock))
+    goto error;
+
+  BEGIN_ALLOW_THREADS_LOCKED(self->lock);
+  status = X509_REQ_verify(self->pkcs10, pkey);
+  END_ALLOW_THREADS_LOCKED(self->lock);
+
+  if (status < 0)
     lose_openssl_error("Couldn't verify PKCS#10 signature");
 
   EVP_PKEY_free(pkey);
@@ -10172,6 +10296,59 @@ static struct PyMethodDef pow_module_methods[] = {
 
 
 
+/*
+ * OpenSSL before 1.1.0 needs locking callbacks to be safe with
+ * multiple threads.  We can't count on Python's _ssl module having
+ * installed these for us, because we link against our own copy of
+ * OpenSSL, so we install our own, using Python's portable locks.
+ * Without these, it would not be safe for the methods above to
+ * release the GIL while OpenSSL is working.
+ */
+
+#if OPENSSL_VERSION_NUMBER < 0x10100000L
+
+static PyThread_type_lock *openssl_locks = NULL;
+
+static void
+openssl_locking_callback(int mode, int n, GCC_UNUSED const char *file, GCC_UNUSED int line)
+{
+  if (mode & CRYPTO_LOCK)
+    PyThread_acquire_lock(openssl_locks[n], WAIT_LOCK);
+  else
+    PyThread_release_lock(openssl_locks[n]);
+}
+
+static int
+setup_openssl_threads(void)
+{
+  int i, n = CRYPTO_num_locks();
+
+  if (CRYPTO_get_locking_callback() != NULL)
+    return 1;
+
+  if ((openssl_locks = PyMem_Malloc(n * sizeof(*openssl_locks))) == NULL)
+    return 0;
+
+  for (i = 0; i < n; i++)
+    if ((openssl_locks[i] = PyThread_allocate_lock()) == NULL)
+      return 0;
+
+  CRYPTO_set_locking_callback(openssl_locking_callback);
+  return 1;
+}
+
+#else
+
+static int
+setup_openssl_threads(void)
+{
+  return 1;
+}
+
+#endif
+
+
+
 /*
  * Module initialization.
  */
@@ -10183,22 +10360,13 @@ init_POW(void)
   int OpenSSL_ok = 1;
 
   /*
-   * Python encourages us to use these functions instead of the ones
-   * in libc, and OpenSSL allows us to do this.  The result seems to
-   * work, and, in theory, gives Python's memory allocator a better
-   * idea of how much memory we're really using.  Not sure why it
-   * cares, but let's try to be nice about it.
-   *
-   * Note that this must be done BEFORE anything in OpenSSL uses
-   * dynamic memory, and that this will probably fail in horrible ways
-   * without the build-time code (-Bsymbolic, etc) which isolates our
-   * copy of the OpenSSL code from any system shared libraries.
-   * Enough other things already fail in horrible ways without that
-   * isolation that adding one more doesn't make much difference, but
-   * if you tinker with the build script and start seeing nasty
-   * memory-related issues, this might be the cause.
+   * We used to point OpenSSL at PyMem_Malloc() and friends here, to
+   * give Python's memory allocator a better idea of how much memory
+   * we're really using.  That's no longer safe: some methods release
+   * the GIL while OpenSSL works, and PyMem_Malloc() requires the GIL
+   * (debug builds route it through pymalloc's debugging hooks).  So
+   * OpenSSL keeps its default, libc's malloc(), realloc() and free().
    */
-  CRYPTO_set_mem_functions(PyMem_Malloc, PyMem_Realloc, PyMem_Free);
 
   /*
    * Import the DateTime API
@@ -10348,6 +10516,8 @@ init_POW(void)
 
   OpenSSL_ok &= create_missing_nids();
 
+  OpenSSL_ok &= setup_openssl_threads();
+
   x509_store_ctx_ex_data_idx = X509_STORE_CTX_get_ex_new_index(0, "x590_store_ctx_object for verify callback",
                                                                NULL, NULL, NULL);
 
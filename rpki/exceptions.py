@@ -247,3 +247,6 @@ class ResourceClassMismatch(RPKI_Exception):
 
 class IRDBExpired(RPKI_Exception):
     "Back-end database record has expired."
+
+class CryptoTimeout(RPKI_Exception):
+    "Crypto worker process took too long to respond."
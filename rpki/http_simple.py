@@ -24,6 +24,7 @@ need the full-blown rpki.http asynchronous code.
 import logging
 import httplib
 import urlparse
+import SocketServer
 import BaseHTTPServer
 
 logger = logging.getLogger(__name__)
@@ -73,9 +74,20 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
 
 
-def server(handlers, port, host = ""):
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server which handles each request in its own thread.
+    """
+
+    daemon_threads = True
+
+
+def server(handlers, port, host = "", threaded = False):
     """
     Run an HTTP server and wait (forever) for connections.
+
+    If threaded is set, each request runs in its own thread, so
+    handlers must be prepared to deal with concurrency.
     """
 
     if isinstance(handlers, (tuple, list)):
@@ -87,7 +99,9 @@ def server(handlers, port, host = ""):
     class RequestHandler(HTTPRequestHandler):
         rpki_handlers = handlers
 
-    BaseHTTPServer.HTTPServer((host, port), RequestHandler).serve_forever()
+    server_class = ThreadingHTTPServer if threaded else BaseHTTPServer.HTTPServer
+
+    server_class((host, port), RequestHandler).serve_forever()
 
 
 class BadURL(Exception):
@@ -29,6 +29,8 @@ import time
 import socket
 import logging
 import argparse
+import threading
+import multiprocessing.pool
 
 import rpki.resource_set
 import rpki.x509
@@ -124,14 +126,43 @@ class main(object):
         self.rrdp_expiration_interval = rpki.sundial.timedelta.parse(self.cfg.get("rrdp-expiration-interval", "6h"))
         self.rrdp_publication_base = self.cfg.get("rrdp-publication-base", "rrdp-publication/")
 
+        # Commit window is in milliseconds, zero means process each
+        # client query as soon as it arrives.
+
+        self.commit_window   = self.cfg.getint("commit-window", 0) / 1000.0
+        self.commit_max_pdus = self.cfg.getint("commit-max-pdus", 10000)
+
+        self.session_lock = threading.RLock()
+
+        # fsync()ing every new file and touched directory in the rsync
+        # tree is expensive, so, as before we had the option, we don't
+        # unless asked to.
+
+        self.rsync_fsync = self.cfg.getboolean("rsync-fsync", False)
+        rsync_writer_threads = self.cfg.getint("rsync-writer-threads", 4)
+        if rsync_writer_threads > 1:
+            self.rsync_pool = multiprocessing.pool.ThreadPool(rsync_writer_threads)
+        else:
+            self.rsync_pool = None
+
+        crypto_processes = self.cfg.getint("crypto-processes", 0)
+        if crypto_processes > 0:
+            rpki.x509.crypto_executor = rpki.x509.CryptoExecutor(crypto_processes)
+
         try:
             self.session = rpki.pubdb.models.Session.objects.get()
         except rpki.pubdb.models.Session.DoesNotExist:
             self.session = rpki.pubdb.models.Session.objects.create(uuid = str(uuid.uuid4()), serial = 0)
 
+        if self.commit_window > 0:
+            self.batcher = ClientQueryBatcher(self.process_client_queries, self.commit_window, self.commit_max_pdus)
+        else:
+            self.batcher = None
+
         rpki.http_simple.server(
             host     = self.http_server_host,
             port     = self.http_server_port,
+            threaded = self.batcher is not None,
             handlers = (("/control", self.control_handler),
                         ("/client/", self.client_handler)))
 
@@ -153,9 +184,13 @@ class main(object):
             r_msg = Element(rpki.publication_control.tag_msg, nsmap = rpki.publication_control.nsmap,
                             type = "reply", version = rpki.publication_control.version)
 
+            # Changes to clients are serialized with the batch worker by
+            # the same lock it holds while processing client queries, so a
+            # client can't be modified or destroyed under a batch in flight.
+
             try:
                 q_pdu = None
-                with transaction.atomic():
+                with self.session_lock, transaction.atomic():
 
                     for q_pdu in q_msg:
                         if q_pdu.tag != rpki.publication_control.tag_client:
@@ -206,6 +241,7 @@ class main(object):
 
                         if action == "destroy":
                             rpki.pubdb.models.Client.objects.filter(client_handle = client_handle).delete()
+                            self.session.forget_rrdp_files()
                             r_pdu = SubElement(r_msg, q_pdu.tag, action = action, client_handle = client_handle)
                             if q_pdu.get("tag"):
                                 r_pdu.set("tag", q_pdu.get("tag"))
@@ -223,6 +259,10 @@ class main(object):
             logger.exception("Unhandled exception processing control query, path %r", request.path)
             request.send_error(500, "Unhandled exception %s: %s" % (e.__class__.__name__, e))
 
+        finally:
+            if self.batcher is not None:
+                connection.close()        # Request threads are short-lived, don't leak their connections
+
 
     client_url_regexp = re.compile("/client/([-A-Z0-9_/]+)$", re.I)
 
@@ -231,7 +271,7 @@ class main(object):
         Process one PDU from a client.
         """
 
-        from django.db import transaction, connection
+        from django.db import connection
 
         try:
             connection.cursor()           # Reconnect to mysqld if necessary
@@ -242,67 +282,187 @@ class main(object):
             q_cms = rpki.publication.cms_msg(DER = q_der)
             q_msg = q_cms.unwrap((self.bpki_ta, client.bpki_cert, client.bpki_glue))
             client.last_cms_timestamp = q_cms.check_replay(client.last_cms_timestamp, client.client_handle)
-            client.save()
+            client.save(update_fields = ["last_cms_timestamp"])
             if q_msg.get("type") != "query":
                 raise rpki.exceptions.BadQuery("Message type is %s, expected query" % q_msg.get("type"))
-            r_msg = Element(rpki.publication.tag_msg, nsmap = rpki.publication.nsmap,
-                            type = "reply", version = rpki.publication.version)
+            if self.batcher is None:
+                r_msg = self.process_client_queries([(client, q_msg)])[0]
+            else:
+                r_msg = self.batcher.submit(client, q_msg)
+            request.send_cms_response(rpki.publication.cms_msg().wrap(r_msg, self.pubd_key, self.pubd_cert, self.pubd_crl))
+
+        except Exception as e:
+            logger.exception("Unhandled exception processing client query, path %r", request.path)
+            request.send_error(500, "Could not process PDU: %s" % e)
+
+        finally:
+            if self.batcher is not None:
+                connection.close()        # Request threads are short-lived, don't leak their connections
+
+
+    def process_client_queries(self, queries):
+        """
+        Process a sequence of (client, q_msg) queries as a single RRDP
+        delta, returning a list of reply messages in the same order.
+
+        Each query is atomic: an error rolls back that query's changes
+        but not those of other queries in the same batch.  The RRDP and
+        rsync trees have been updated by the time this returns.
+        """
+
+        from django.db import transaction, connection
+
+        with self.session_lock:
+            connection.cursor()           # Reconnect to mysqld if necessary
+            r_msgs = []
             delta = None
             try:
                 with transaction.atomic():
-                    for q_pdu in q_msg:
-                        if q_pdu.get("uri"):
-                            logger.info("Client %s request for %s", q_pdu.tag, q_pdu.get("uri"))
-                        else:
-                            logger.info("Client %s request", q_pdu.tag)
-
-                        if q_pdu.tag == rpki.publication.tag_list:
-                            for obj in client.publishedobject_set.all():
-                                r_pdu = SubElement(r_msg, q_pdu.tag, uri = obj.uri, hash = obj.hash)
-                                if q_pdu.get("tag") is not None:
-                                    r_pdu.set("tag", q_pdu.get("tag"))
-
-                        else:
-                            assert q_pdu.tag in (rpki.publication.tag_publish, rpki.publication.tag_withdraw)
-                            if delta is None:
-                                delta = self.session.new_delta(rpki.sundial.now() + self.rrdp_expiration_interval)
-                            client.check_allowed_uri(q_pdu.get("uri"))
-                            if q_pdu.tag == rpki.publication.tag_publish:
-                                der = q_pdu.text.decode("base64")
-                                logger.info("Publishing %s", rpki.x509.uri_dispatch(q_pdu.get("uri"))(DER = der).tracking_data(q_pdu.get("uri")))
-                                delta.publish(client, der, q_pdu.get("uri"), q_pdu.get("hash"))
+                    for client, q_msg in queries:
+                        r_msg = Element(rpki.publication.tag_msg, nsmap = rpki.publication.nsmap,
+                                        type = "reply", version = rpki.publication.version)
+                        r_msgs.append(r_msg)
+                        savepoint = None if delta is None else delta.savepoint()
+                        q_pdu = None
+                        try:
+                            with transaction.atomic():
+                                uris = [pdu.get("uri") for pdu in q_msg if pdu.tag != rpki.publication.tag_list]
+                                if uris:
+                                    if delta is None:
+                                        delta = self.session.new_delta(rpki.sundial.now() + self.rrdp_expiration_interval)
+                                    delta.prefetch(client, uris)
+
+                                for q_pdu in q_msg:
+                                    if q_pdu.get("uri"):
+                                        logger.info("Client %s request for %s", q_pdu.tag, q_pdu.get("uri"))
+                                    else:
+                                        logger.info("Client %s request", q_pdu.tag)
+
+                                    if q_pdu.tag == rpki.publication.tag_list:
+                                        if delta is not None:
+                                            delta.flush()
+                                        for uri, obj_hash in client.publishedobject_set.values_list("uri", "hash").iterator():
+                                            r_pdu = SubElement(r_msg, q_pdu.tag, uri = uri, hash = obj_hash)
+                                            if q_pdu.get("tag") is not None:
+                                                r_pdu.set("tag", q_pdu.get("tag"))
+
+                                    else:
+                                        assert q_pdu.tag in (rpki.publication.tag_publish, rpki.publication.tag_withdraw)
+                                        client.check_allowed_uri(q_pdu.get("uri"))
+                                        if q_pdu.tag == rpki.publication.tag_publish:
+                                            der = q_pdu.text.decode("base64")
+                                            logger.info("Publishing %s", rpki.x509.uri_dispatch(q_pdu.get("uri"))(DER = der).tracking_data(q_pdu.get("uri")))
+                                            delta.publish(client, der, q_pdu.get("uri"), q_pdu.get("hash"))
+                                        else:
+                                            logger.info("Withdrawing %s", q_pdu.get("uri"))
+                                            delta.withdraw(client, q_pdu.get("uri"), q_pdu.get("hash"))
+                                        r_pdu = SubElement(r_msg, q_pdu.tag, uri = q_pdu.get("uri"))
+                                        if q_pdu.get("tag") is not None:
+                                            r_pdu.set("tag", q_pdu.get("tag"))
+
+                                if delta is not None:
+                                    delta.flush()
+
+                        except Exception as e:
+                            q_hash = None if q_pdu is None else q_pdu.get("hash")
+                            q_uri  = None if q_pdu is None else q_pdu.get("uri")
+                            if isinstance(e, (rpki.exceptions.ExistingObjectAtURI,
+                                              rpki.exceptions.DifferentObjectAtURI,
+                                              rpki.exceptions.NoObjectAtURI)):
+                                logger.warn("Database synchronization error processing PDU %r hash %s uri %s: %s",
+                                            q_pdu, q_hash, q_uri, e)
                             else:
-                                logger.info("Withdrawing %s", q_pdu.get("uri"))
-                                delta.withdraw(client, q_pdu.get("uri"), q_pdu.get("hash"))
-                            r_pdu = SubElement(r_msg, q_pdu.tag, uri = q_pdu.get("uri"))
-                            if q_pdu.get("tag") is not None:
+                                logger.exception("Exception processing PDU %r hash = %s uri = %s",
+                                                 q_pdu, q_hash, q_uri)
+                            r_pdu = SubElement(r_msg, rpki.publication.tag_report_error, error_code = e.__class__.__name__)
+                            r_pdu.text = str(e)
+                            if q_pdu is not None and q_pdu.get("tag") is not None:
                                 r_pdu.set("tag", q_pdu.get("tag"))
+                            if delta is not None:
+                                delta.rollback(savepoint)
 
-                    if delta is not None:
+                    if delta is not None and delta.changes:
                         delta.activate(self.rrdp_publication_base)
                         self.session.expire_deltas()
 
-            except Exception as e:
-                if isinstance(e, (rpki.exceptions.ExistingObjectAtURI,
-                                  rpki.exceptions.DifferentObjectAtURI,
-                                  rpki.exceptions.NoObjectAtURI)):
-                    logger.warn("Database synchronization error processing PDU %r hash %s uri %s: %s",
-                                q_pdu, q_pdu.get("hash"), q_pdu.get("uri"), e)
-                else:
-                    logger.exception("Exception processing PDU %r hash = %s uri = %s",
-                                     q_pdu, q_pdu.get("hash"), q_pdu.get("uri"))
-                r_pdu = SubElement(r_msg, rpki.publication.tag_report_error, error_code = e.__class__.__name__)
-                r_pdu.text = str(e)
-                if q_pdu.get("tag") is not None:
-                    r_pdu.set("tag", q_pdu.get("tag"))
+                if delta is not None and delta.changes:
+                    self.session.synchronize_rrdp_files(self.rrdp_publication_base, self.rrdp_base_uri, delta)
+                    delta.update_rsync_files(self.publication_base, self.rsync_pool, self.rsync_fsync)
 
-            else:
-                if delta is not None:
-                    self.session.synchronize_rrdp_files(self.rrdp_publication_base, self.rrdp_base_uri)
-                    delta.update_rsync_files(self.publication_base)
+            except:
+                self.session.forget_rrdp_files()
+                raise
 
-            request.send_cms_response(rpki.publication.cms_msg().wrap(r_msg, self.pubd_key, self.pubd_cert, self.pubd_crl))
+            return r_msgs
 
-        except Exception as e:
-            logger.exception("Unhandled exception processing client query, path %r", request.path)
-            request.send_error(500, "Could not process PDU: %s" % e)
+
+class ClientQueryBatcher(object):
+    """
+    Accumulate queries from pubd's clients for up to a commit window
+    (or until enough PDUs have arrived), then process them all as a
+    single RRDP delta on a worker thread.  Each caller blocks until the
+    batch containing its query has been committed and written out.
+    """
+
+    class Pending(object):
+
+        def __init__(self, client, q_msg):
+            self.client = client
+            self.q_msg = q_msg
+            self.r_msg = None
+            self.exception = None
+            self.done = threading.Event()
+
+
+    def __init__(self, handler, window, max_pdus):
+        self.handler = handler
+        self.window = window
+        self.max_pdus = max_pdus
+        self.cond = threading.Condition()
+        self.queue = []
+        self.pdus = 0
+        worker = threading.Thread(target = self.worker, name = "commit")
+        worker.daemon = True
+        worker.start()
+
+
+    def submit(self, client, q_msg):
+        """
+        Queue a query and wait for its reply.
+        """
+
+        pending = self.Pending(client, q_msg)
+        with self.cond:
+            self.queue.append(pending)
+            self.pdus += len(q_msg)
+            self.cond.notify()
+        pending.done.wait()
+        if pending.exception is not None:
+            raise pending.exception
+        return pending.r_msg
+
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                deadline = time.time() + self.window
+                while self.max_pdus <= 0 or self.pdus < self.max_pdus:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.queue, self.pdus = self.queue, [], 0
+            logger.debug("Committing batch of %d client queries", len(batch))
+            try:
+                r_msgs = self.handler([(pending.client, pending.q_msg) for pending in batch])
+            except Exception as e:
+                logger.exception("Unhandled exception processing batch of client queries")
+                for pending in batch:
+                    pending.exception = e
+            else:
+                for pending, r_msg in zip(batch, r_msgs):
+                    pending.r_msg = r_msg
+            for pending in batch:
+                pending.done.set()
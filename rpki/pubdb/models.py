@@ -23,9 +23,10 @@ Django ORM models for pubd.
 from __future__ import unicode_literals
 from django.db import models
 from rpki.fields import CertificateField, SundialField
-from lxml.etree import Element, SubElement, ElementTree, xmlfile as XMLFile
+from lxml.etree import Element, SubElement, ElementTree, tostring, xmlfile as XMLFile
 
 import os
+import errno
 import logging
 import rpki.exceptions
 import rpki.relaxng
@@ -49,6 +50,11 @@ rrdp_tag_publish      = rrdp_xmlns + "publish"
 rrdp_tag_snapshot     = rrdp_xmlns + "snapshot"
 rrdp_tag_withdraw     = rrdp_xmlns + "withdraw"
 
+# Maximum number of values we put into a single SQL "IN" clause or
+# bulk INSERT.  SQLite in particular has a low limit on query parameters.
+
+sql_chunk_size = 500
+
 
 # This would probably be useful to more than just this module, not
 # sure quite where to put it at the moment.
@@ -64,19 +70,6 @@ def DERSubElement(elt, name, der, attrib = None, **kwargs):
     return se
 
 
-def sha256_file(f):
-    """
-    Read data from a file-like object, return hex-encoded sha256 hash.
-    """
-
-    h = rpki.POW.Digest(rpki.POW.SHA256_DIGEST)
-    while True:
-        x = f.read(8192)
-        if len(x) == 0:
-            return h.digest().encode("hex")
-        h.update(x)
-
-
 class Client(models.Model):
     client_handle = models.CharField(unique = True, max_length = 255)
     base_uri = models.TextField()
@@ -94,10 +87,112 @@ class Client(models.Model):
             raise rpki.exceptions.ForbiddenURI
 
 
+class HashingWriter(object):
+    """
+    Minimal file-like object which computes a hex-encoded SHA-256 hash
+    of everything written through it, so we don't have to read files
+    back after writing them just to hash them.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = rpki.POW.Digest(rpki.POW.SHA256_DIGEST)
+
+    def write(self, data):
+        self.f.write(data)
+        self.digest.update(data)
+
+    def hexdigest(self):
+        return self.digest.digest().encode("hex")
+
+
+class SnapshotWriter(object):
+    """
+    Write an RRDP snapshot file as a sequence of pre-rendered <publish/>
+    elements, hashing as we go and recording where each element landed
+    in the file, so that the next snapshot can copy unchanged elements
+    verbatim instead of regenerating them from the database.
+    """
+
+    def __init__(self, f, session):
+        self.f = HashingWriter(f)
+        self.offset = 0
+        self.index = {}
+        self.write(('<snapshot xmlns="%s" version="%s" session_id="%s" serial="%s">\n' % (
+            rrdp_nsmap[None], rrdp_version, session.uuid, session.serial)).encode("ascii"))
+
+
+    def write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+
+    @staticmethod
+    def render(uri, der):
+        # Rendered without a namespace so that lxml doesn't repeat the
+        # xmlns declaration on every element: once this text is inside
+        # the <snapshot/> element, its default namespace applies.
+        e = Element("publish", uri = uri)
+        e.text = rpki.x509.base64_with_linebreaks(der)
+        e.tail = "\n"
+        return tostring(e)
+
+
+    def publish(self, uri, der):
+        text = self.render(uri, der)
+        self.index[uri] = (self.offset, len(text))
+        self.write(text)
+
+
+    def copy(self, f, entries):
+        """
+        Copy <publish/> elements from a previous snapshot file.  Entries
+        are (offset, length, uri) tuples sorted by offset; adjacent
+        elements are coalesced so that we copy large runs at a time.
+        """
+
+        run = []
+        for entry in entries:
+            if run and entry[0] != run[-1][0] + run[-1][1]:
+                self._copy_run(f, run)
+                run = []
+            run.append(entry)
+        if run:
+            self._copy_run(f, run)
+
+
+    def _copy_run(self, f, run):
+        start = run[0][0]
+        end   = run[-1][0] + run[-1][1]
+        for offset, length, uri in run:
+            self.index[uri] = (self.offset + offset - start, length)
+        f.seek(start)
+        while start < end:
+            data = f.read(min(end - start, 65536))
+            if len(data) == 0:
+                raise IOError("Unexpected EOF copying from %s" % f.name)
+            self.write(data)
+            start += len(data)
+
+
+    def close(self):
+        self.write(b"</snapshot>\n")
+        return self.f.hexdigest()
+
+
 class Session(models.Model):
     uuid = models.CharField(unique = True, max_length=36)
     serial = models.BigIntegerField()
 
+    # In-memory state describing RRDP files we have already written.
+    # These are not database fields: they last as long as the pubd
+    # process's Session object, and are rebuilt from scratch (one full
+    # snapshot write, one directory walk) on restart or after an error.
+
+    _snapshot_index    = None           # uri -> (offset, length) in _snapshot_index_fn
+    _snapshot_index_fn = None           # Snapshot file described by _snapshot_index
+    _rrdp_filenames    = None           # RRDP files current as of last synchronization
+
 
     def new_delta(self, expires):
         """
@@ -114,6 +209,8 @@ class Session(models.Model):
                             version = rrdp_version,
                             session_id = self.uuid,
                             serial = str(delta.serial))
+        delta.changes = []
+        delta._discard_queued()
         return delta
 
 
@@ -125,6 +222,19 @@ class Session(models.Model):
         self.delta_set.filter(expires__lt = rpki.sundial.now()).delete()
 
 
+    def forget_rrdp_files(self):
+        """
+        Discard in-memory knowledge of RRDP files on disk, forcing the
+        next synchronization to regenerate everything.  Call this when
+        something has gone wrong and the files may no longer match the
+        database.
+        """
+
+        self._snapshot_index = None
+        self._snapshot_index_fn = None
+        self._rrdp_filenames = None
+
+
     @property
     def snapshot_fn(self):
         return "%s/snapshot/%s.xml" % (self.uuid, self.serial)
@@ -140,24 +250,47 @@ class Session(models.Model):
         return "%s/%s" % (rrdp_base_uri.rstrip("/"), fn)
 
 
-    def write_snapshot_file(self, rrdp_publication_base):
+    def write_snapshot_file(self, rrdp_publication_base, delta = None):
+        """
+        Write snapshot file for the current serial, return its hash.
+
+        Given the delta which took us from the previous snapshot to this
+        one, we build the new snapshot by copying unchanged elements from
+        the previous snapshot file and appending the objects the delta
+        published, so the cost scales with the size of the delta rather
+        than the size of the repository.  Without a delta, or if we have
+        no usable previous snapshot, we generate it from the database.
+        """
+
         fn = os.path.join(rrdp_publication_base, self.snapshot_fn)
         tn = fn + ".%s.tmp" % os.getpid()
         dn = os.path.dirname(fn)
         if not os.path.isdir(dn):
             os.makedirs(dn)
-        with open(tn, "wb+") as f:
-            with XMLFile(f) as xf:
-                with xf.element(rrdp_tag_snapshot, nsmap = rrdp_nsmap,
-                                version = rrdp_version, session_id = self.uuid, serial = str(self.serial)):
-                    xf.write("\n")
-                    for obj in self.publishedobject_set.all():
-                        e = Element(rrdp_tag_publish, nsmap = rrdp_nsmap, uri = obj.uri)
-                        e.text = rpki.x509.base64_with_linebreaks(obj.der)
-                        xf.write(e, pretty_print = True)
-            f.seek(0)
-            h = sha256_file(f)
+        old_fn = self._snapshot_index_fn
+        incremental = (delta is not None and
+                       self._snapshot_index is not None and
+                       old_fn != fn and
+                       os.path.exists(old_fn))
+        with open(tn, "wb") as f:
+            writer = SnapshotWriter(f, self)
+            if incremental:
+                changes = dict(delta.changes)
+                with open(old_fn, "rb") as old:
+                    writer.copy(old, sorted((offset, length, uri)
+                                            for uri, (offset, length) in self._snapshot_index.iteritems()
+                                            if uri not in changes))
+                for uri, der in changes.iteritems():
+                    if der is not None:
+                        writer.publish(uri, der)
+            else:
+                for uri, der in self.publishedobject_set.values_list("uri", "der"):
+                    writer.publish(uri, der)
+            h = writer.close()
         os.rename(tn, fn)
+        logger.debug("Wrote %s snapshot %s, %s objects", "incremental" if incremental else "full", fn, len(writer.index))
+        self._snapshot_index = writer.index
+        self._snapshot_index_fn = fn
         return h
 
 
@@ -181,36 +314,45 @@ class Session(models.Model):
         os.rename(tn, fn)
 
 
-    def synchronize_rrdp_files(self, rrdp_publication_base, rrdp_base_uri):
+    def synchronize_rrdp_files(self, rrdp_publication_base, rrdp_base_uri, delta = None):
         """
         Write current RRDP files to disk, clean up old files and directories.
+
+        The first time through we walk the whole RRDP tree looking for
+        debris; after that, we know which files we wrote, so we just
+        remove the ones which are no longer current.
         """
 
-        if os.path.isdir(rrdp_publication_base):
-            current_filenames = set(fn for fn in os.listdir(rrdp_publication_base)
-                                    if fn.endswith(".cer") or fn.endswith(".tal"))
-        else:
-            current_filenames = set()
+        snapshot_hash = self.write_snapshot_file(rrdp_publication_base, delta)
 
-        snapshot_hash = self.write_snapshot_file(rrdp_publication_base)
-        current_filenames.add(self.snapshot_fn)
+        current_filenames = set((self.snapshot_fn, self.notification_fn))
+        current_filenames.update(d.fn for d in self.delta_set.all())
 
-        for delta in self.delta_set.all():
-            current_filenames.add(delta.fn)
+        self.write_notification_xml(rrdp_base_uri, snapshot_hash, rrdp_publication_base)
 
-        self.write_notification_xml(rrdp_base_uri, snapshot_hash, rrdp_publication_base),
-        current_filenames.add(self.notification_fn)
+        if self._rrdp_filenames is None:
+            current_filenames.update(fn for fn in os.listdir(rrdp_publication_base)
+                                     if fn.endswith(".cer") or fn.endswith(".tal"))
+            for root, dirs, files in os.walk(rrdp_publication_base, topdown = False):
+                for fn in files:
+                    fn = os.path.join(root, fn)
+                    if fn[len(rrdp_publication_base):].lstrip("/") not in current_filenames:
+                        os.remove(fn)
+                for dn in dirs:
+                    try:
+                        os.rmdir(os.path.join(root, dn))
+                    except OSError:
+                        pass
 
-        for root, dirs, files in os.walk(rrdp_publication_base, topdown = False):
-            for fn in files:
-                fn = os.path.join(root, fn)
-                if fn[len(rrdp_publication_base):].lstrip("/") not in current_filenames:
-                    os.remove(fn)
-            for dn in dirs:
+        else:
+            for fn in self._rrdp_filenames - current_filenames:
                 try:
-                    os.rmdir(os.path.join(root, dn))
-                except OSError:
-                    pass
+                    os.remove(os.path.join(rrdp_publication_base, fn))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        self._rrdp_filenames = current_filenames
 
 
 class Delta(models.Model):
@@ -238,85 +380,240 @@ class Delta(models.Model):
 
 
     def activate(self, rrdp_publication_base):
-        rpki.relaxng.rrdp.assertValid(self.xml)
+        # PDUs were validated as they were added, so all that's left is
+        # to stream them out, hashing as we go.
         fn = os.path.join(rrdp_publication_base, self.fn)
         tn = fn + ".%s.tmp" % os.getpid()
         dn = os.path.dirname(fn)
         if not os.path.isdir(dn):
             os.makedirs(dn)
-        with open(tn, "wb+") as f:
-            ElementTree(self.xml).write(file = f, pretty_print = True)
-            f.flush()
-            f.seek(0)
-            self.hash = sha256_file(f)
+        with open(tn, "wb") as f:
+            hf = HashingWriter(f)
+            with XMLFile(hf) as xf:
+                with xf.element(rrdp_tag_delta, nsmap = rrdp_nsmap, version = rrdp_version,
+                                session_id = self.session.uuid, serial = str(self.serial)):
+                    xf.write("\n")
+                    for pdu in self.xml:
+                        xf.write(pdu, pretty_print = True)
+            self.hash = hf.hexdigest()
         os.rename(tn, fn)
         self.save()
         self.session.serial += 1
         self.session.save()
 
 
+    def savepoint(self):
+        """
+        Return a marker for the current state of this delta's in-memory
+        changes, for use with rollback().
+        """
+
+        return len(self.changes)
+
+
+    def rollback(self, savepoint = None):
+        """
+        Discard in-memory changes made since savepoint (default: all of
+        them).  This does not touch the database, callers are expected to
+        roll back the corresponding database transaction themselves.
+        Database changes queued since the last flush() are discarded.
+        """
+
+        savepoint = savepoint or 0
+        del self.changes[savepoint:]
+        del self.xml[savepoint:]
+        self._discard_queued()
+
+
+    def _pdu_wrapper(self):
+        return Element(rrdp_tag_delta, nsmap = rrdp_nsmap, version = rrdp_version,
+                       session_id = self.session.uuid, serial = str(self.serial))
+
+
+    def _add_pdu(self, pdu, change):
+        """
+        Validate a single PDU and add it to this delta.
+
+        The PDU arrives in an otherwise empty delta element from
+        _pdu_wrapper(), so we validate just this PDU rather than
+        revalidating everything accumulated so far, which made large
+        publications quadratic.
+        """
+
+        rpki.relaxng.rrdp.assertValid(pdu.getparent())
+        self.xml.append(pdu)
+        self.changes.append(change)
+
+
+    def prefetch(self, client, uris):
+        """
+        Look up, in bulk, whatever the client currently has published at
+        the given URIs, so that publish() and withdraw() don't have to
+        query the database once per PDU.  Database changes are queued
+        until flush().
+        """
+
+        uris = list(set(uris))
+        for i in xrange(0, len(uris), sql_chunk_size):
+            for pk, uri, obj_hash in client.publishedobject_set.filter(
+                    session = self.session, uri__in = uris[i : i + sql_chunk_size]).values_list("pk", "uri", "hash"):
+                self._current[uri] = (pk, obj_hash)
+        for uri in uris:
+            self._current.setdefault(uri, None)
+
+
+    def _lookup(self, client, uri):
+        """
+        Return (pk, hash) of the object currently at uri, or None.  pk is
+        None for objects we've queued for insertion but not yet written.
+        """
+
+        if uri not in self._current:
+            self.prefetch(client, (uri,))
+        return self._current[uri]
+
+
+    def _remove(self, uri):
+        pk, obj_hash = self._current[uri]
+        if pk is None:
+            del self._inserts[uri]
+        else:
+            self._deletes.append(pk)
+        self._current[uri] = None
+
+
+    def flush(self):
+        """
+        Write queued database changes: deletions first, since new objects
+        may be replacing old ones at the same URIs.
+        """
+
+        for i in xrange(0, len(self._deletes), sql_chunk_size):
+            PublishedObject.objects.filter(pk__in = self._deletes[i : i + sql_chunk_size]).delete()
+        PublishedObject.objects.bulk_create(self._inserts.itervalues(), batch_size = sql_chunk_size)
+        self._discard_queued()
+
+
+    def _discard_queued(self):
+        self._current = {}
+        self._inserts = {}
+        self._deletes = []
+
+
     def publish(self, client, der, uri, obj_hash):
-        try:
-            obj = client.publishedobject_set.get(session = self.session, uri = uri)
-            if obj.hash == obj_hash:
-                obj.delete()
+        old = self._lookup(client, uri)
+        if old is not None:
+            if old[1] == obj_hash:
+                self._remove(uri)
             elif obj_hash is None:
                 raise rpki.exceptions.ExistingObjectAtURI("Object already published at %s" % uri)
             else:
-                raise rpki.exceptions.DifferentObjectAtURI("Found different object at %s (old %s, new %s)" % (uri, obj.hash, obj_hash))
-        except rpki.pubdb.models.PublishedObject.DoesNotExist:
-            pass
+                raise rpki.exceptions.DifferentObjectAtURI("Found different object at %s (old %s, new %s)" % (uri, old[1], obj_hash))
         logger.debug("Publishing %s", uri)
-        PublishedObject.objects.create(session = self.session, client = client, der = der, uri = uri,
-                                       hash = rpki.x509.sha256(der).encode("hex"))
-        se = DERSubElement(self.xml, rrdp_tag_publish, der = der, uri = uri)
+        new_hash = rpki.x509.sha256(der).encode("hex")
+        self._inserts[uri] = PublishedObject(session = self.session, client = client, der = der, uri = uri, hash = new_hash)
+        self._current[uri] = (None, new_hash)
+        pdu = DERSubElement(self._pdu_wrapper(), rrdp_tag_publish, der = der, uri = uri)
         if obj_hash is not None:
-            se.set("hash", obj_hash)
-        rpki.relaxng.rrdp.assertValid(self.xml)
+            pdu.set("hash", obj_hash)
+        self._add_pdu(pdu, (uri, der))
 
 
     def withdraw(self, client, uri, obj_hash):
-        try:
-            obj = client.publishedobject_set.get(session = self.session, uri = uri)
-        except rpki.pubdb.models.PublishedObject.DoesNotExist:
+        old = self._lookup(client, uri)
+        if old is None:
             raise rpki.exceptions.NoObjectAtURI("No published object found at %s" % uri)
-        if obj.hash != obj_hash:
-            raise rpki.exceptions.DifferentObjectAtURI("Found different object at %s (old %s, new %s)" % (uri, obj.hash, obj_hash))
+        if old[1] != obj_hash:
+            raise rpki.exceptions.DifferentObjectAtURI("Found different object at %s (old %s, new %s)" % (uri, old[1], obj_hash))
         logger.debug("Withdrawing %s", uri)
-        obj.delete()
-        SubElement(self.xml, rrdp_tag_withdraw, uri = uri, hash = obj_hash).tail = "\n"
-        rpki.relaxng.rrdp.assertValid(self.xml)
+        self._remove(uri)
+        pdu = SubElement(self._pdu_wrapper(), rrdp_tag_withdraw, uri = uri, hash = obj_hash)
+        pdu.tail = "\n"
+        self._add_pdu(pdu, (uri, None))
+
+
+    @staticmethod
+    def _write_rsync_directory(dn, files, fsync):
+        """
+        Write temporary files for new objects in one directory of the
+        rsync tree.  Runs in a worker thread when we have a pool.
+        """
+
+        try:
+            os.makedirs(dn)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for fn, der in files:
+            with open(fn + ".tmp", "wb") as f:
+                f.write(der)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+
+    @staticmethod
+    def _fsync_directory(dn):
+        fd = os.open(dn, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
-    def update_rsync_files(self, publication_base):
-        from errno import ENOENT
+    def update_rsync_files(self, publication_base, pool = None, fsync = False):
+        """
+        Apply this delta to the rsync tree.
+
+        New objects are written to temporary files in per-directory
+        batches, in parallel if we're given a thread pool.  Only once all
+        of them are on disk (and, if fsync is set, on stable storage) do
+        we rename them into place and remove withdrawn objects, so the
+        delta appears in the tree all at once rather than piecemeal.
+        """
+
         min_path_len = len(publication_base.rstrip("/"))
-        for pdu in self.xml:
-            assert pdu.tag in (rrdp_tag_publish, rrdp_tag_withdraw)
-            fn = self._uri_to_filename(pdu.get("uri"), publication_base)
-            if pdu.tag == rrdp_tag_publish:
-                tn = fn + ".tmp"
-                dn = os.path.dirname(fn)
-                if not os.path.isdir(dn):
-                    os.makedirs(dn)
-                with open(tn, "wb") as f:
-                    f.write(pdu.text.decode("base64"))
-                os.rename(tn, fn)
+        mapper = map if pool is None else pool.map
+
+        # Only the final state of each URI matters.
+        published = {}
+        withdrawn = []
+        for uri, der in dict(self.changes).iteritems():
+            fn = self._uri_to_filename(uri, publication_base)
+            if der is None:
+                withdrawn.append(fn)
             else:
+                published.setdefault(os.path.dirname(fn), []).append((fn, der))
+
+        mapper(lambda item: self._write_rsync_directory(item[0], item[1], fsync), published.iteritems())
+
+        for files in published.itervalues():
+            for fn, der in files:
+                os.rename(fn + ".tmp", fn)
+
+        for fn in withdrawn:
+            try:
+                os.remove(fn)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        withdrawn_dirs = set(os.path.dirname(fn) for fn in withdrawn)
+
+        if fsync:
+            mapper(self._fsync_directory, [dn for dn in set(published) | withdrawn_dirs if os.path.isdir(dn)])
+
+        for dn in sorted(withdrawn_dirs, key = len, reverse = True):
+            while len(dn) > min_path_len:
                 try:
-                    os.remove(fn)
-                except OSError, e:
-                    if e.errno != ENOENT:
-                        raise
-                dn = os.path.dirname(fn)
-                while len(dn) > min_path_len:
-                    try:
-                        os.rmdir(dn)
-                    except OSError:
-                        break
-                    else:
-                        dn = os.path.dirname(dn)
+                    os.rmdir(dn)
+                except OSError:
+                    break
+                else:
+                    dn = os.path.dirname(dn)
+
         del self.xml
+        del self.changes
 
 
 class PublishedObject(models.Model):
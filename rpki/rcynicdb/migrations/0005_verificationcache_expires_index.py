@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rcynicdb', '0004_verificationcache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='verificationcache',
+            name='expires',
+            field=models.DateTimeField(null=True, db_index=True),
+        ),
+    ]
@@ -94,3 +94,31 @@ class RPKIObject(models.Model):
             return "<RPKIObject: uri {0.uri} sha256 {0.sha256} ski {0.ski} aki {0.aki} retrieved {0.retrieved!r}>".format(self)
         except:
             return "<RPKIObject: {}>".format(id(self))
+
+# Result of checking one object against a particular issuer and CRL,
+# so that later runs needn't repeat signature verification for objects
+# which haven't changed.  crl is the hex SHA-256 of the CRL, issuer
+# that of the issuing certificate or, for a longer trusted chain, the
+# hex SHA-256 of the concatenation of the hex digests of every
+# certificate in the chain; either is an empty string if there was
+# none.  status is the space-separated names of the status codes the
+# check recorded.
+# expires is the next time at which the result of the time-dependent
+# checks could change, null if never.
+
+class VerificationCache(models.Model):
+    sha256   = models.SlugField(max_length = 64)
+    issuer   = models.SlugField(max_length = 64)
+    crl      = models.SlugField(max_length = 64)
+    accepted = models.BooleanField()
+    status   = models.TextField()
+    expires  = models.DateTimeField(null = True, db_index = True)
+
+    class Meta:
+        unique_together = ("sha256", "issuer", "crl")
+
+    def __repr__(self):
+        try:
+            return "<VerificationCache: sha256 {0.sha256} issuer {0.issuer} crl {0.crl} accepted {0.accepted}>".format(self)
+        except:
+            return "<VerificationCache: {}>".format(id(self))
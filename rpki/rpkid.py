@@ -44,6 +44,7 @@ from lxml.etree import Element, SubElement, tostring as ElementToString
 import rpki.resource_set
 import rpki.up_down
 import rpki.left_right
+import rpki.POW
 import rpki.x509
 import rpki.config
 import rpki.exceptions
@@ -73,6 +74,7 @@ class main(object):
 
         self.task_queue = tornado.queues.Queue()
         self.task_ready = set()
+        self.task_tenants = dict()
 
         self.http_client_serialize = weakref.WeakValueDictionary()
 
@@ -154,12 +156,26 @@ class main(object):
 
         self.cron_period = self.cfg.getint("cron-period", 1800)
 
+        crypto_processes = self.cfg.getint("crypto-processes", 0)
+        if crypto_processes > 0:
+            rpki.x509.crypto_executor = rpki.x509.CryptoExecutor(crypto_processes)
+
+        rsa_key_pool_directory = self.cfg.get("rsa-key-pool-directory", "")
+        if rsa_key_pool_directory:
+            rpki.x509.rsa_key_pool = rpki.x509.rsa_key_pool_manager(
+                dirname    = rsa_key_pool_directory,
+                low_water  = self.cfg.getint("rsa-key-pool-low-water", 50),
+                high_water = self.cfg.getint("rsa-key-pool-high-water", 200))
+            rpki.x509.rsa_key_pool.start()
+
         if self.use_internal_cron:
             logger.debug("Scheduling initial cron pass in %s seconds", self.initial_delay)
             tornado.ioloop.IOLoop.current().spawn_callback(self.cron_loop)
 
-        logger.debug("Scheduling task loop")
-        tornado.ioloop.IOLoop.current().spawn_callback(self.task_loop)
+        task_concurrency = max(1, self.cfg.getint("task-concurrency", 1))
+        logger.debug("Scheduling %d task loop%s", task_concurrency, "" if task_concurrency == 1 else "s")
+        for i in xrange(task_concurrency):
+            tornado.ioloop.IOLoop.current().spawn_callback(self.task_loop)
 
         rpkid = self
 
@@ -199,6 +215,7 @@ class main(object):
                 logger.debug("Task %r already queued", task)
             else:
                 logger.debug("Adding %r to task queue", task)
+                task.queued = time.time()
                 self.task_queue.put(task)
                 self.task_ready.add(task)
 
@@ -206,6 +223,12 @@ class main(object):
     def task_loop(self):
         """
         Asynchronous infinite loop to run background tasks.
+
+        We may run several of these at once, to keep one slow tenant
+        from holding up everybody else, but tasks for any one tenant
+        still run one at a time, in order: if we pull a task for a
+        tenant which some other loop is already serving, we hand it
+        over to that loop and go back for another.
         """
 
         logger.debug("Starting task loop")
@@ -214,8 +237,24 @@ class main(object):
             task = None
             try:
                 task = yield self.task_queue.get()
-                self.task_ready.discard(task)
-                yield task.start()
+                tenant = task.tenant.pk
+                if tenant in self.task_tenants:
+                    self.task_tenants[tenant].append(task)
+                    continue
+                backlog = self.task_tenants[tenant] = []
+                try:
+                    while task is not None:
+                        self.task_ready.discard(task)
+                        t0 = time.time()
+                        logger.debug("Task %r waited %.3f seconds, %d task(s) queued, %d tenant(s) active",
+                                     task, t0 - task.queued, len(self.task_ready), len(self.task_tenants))
+                        yield task.start()
+                        logger.debug("Task %r ran for %.3f seconds", task, time.time() - t0)
+                        task = backlog.pop(0) if backlog else None
+                finally:
+                    del self.task_tenants[tenant]
+                    for leftover in backlog:
+                        self.task_queue.put(leftover)
             except:
                 logger.exception("Unhandled exception from %r", task)
 
@@ -329,7 +368,7 @@ class main(object):
 
         q_tags = set(q_pdu.tag for q_pdu in q_msg)
 
-        q_der = rpki.left_right.cms_msg().wrap(q_msg, self.rpkid_key, self.rpkid_cert)
+        q_der = yield rpki.left_right.cms_msg().wrap_async(q_msg, self.rpkid_key, self.rpkid_cert)
 
         http_request = tornado.httpclient.HTTPRequest(
             url             = self.irdb_url,
@@ -351,7 +390,7 @@ class main(object):
         r_der = http_response.body
 
         r_cms = rpki.left_right.cms_msg(DER = r_der)
-        r_msg = r_cms.unwrap((self.bpki_ta, self.irdb_cert))
+        r_msg = yield r_cms.unwrap_async((self.bpki_ta, self.irdb_cert))
 
         self.irdbd_cms_timestamp = r_cms.check_replay(self.irdbd_cms_timestamp, self.irdb_url)
 
@@ -537,7 +576,7 @@ class main(object):
 
         try:
             q_cms = rpki.left_right.cms_msg(DER = handler.request.body)
-            q_msg = q_cms.unwrap((self.bpki_ta, self.irbe_cert))
+            q_msg = yield q_cms.unwrap_async((self.bpki_ta, self.irbe_cert))
             r_msg = Element(rpki.left_right.tag_msg, nsmap = rpki.left_right.nsmap,
                             type = "reply", version = rpki.left_right.version)
             self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, handler.request.path)
@@ -594,8 +633,9 @@ class main(object):
                         r_pdu.set("tenant_handle", error_tenant_handle)
                     break
 
+            r_der = yield rpki.left_right.cms_msg().wrap_async(r_msg, self.rpkid_key, self.rpkid_cert)
             handler.set_status(200)
-            handler.finish(rpki.left_right.cms_msg().wrap(r_msg, self.rpkid_key, self.rpkid_cert))
+            handler.finish(r_der)
 
         except Exception, e:
             logger.exception("Unhandled exception serving left-right request")
@@ -642,6 +682,12 @@ class publication_queue(object):
     own completion callback.  Eventually we want to publish everything
     we've accumulated, at which point we need to iterate over the
     collection and do repository.call_pubd() for each repository.
+
+    CRLs and manifests are a special case: many changes to a CA's
+    products each require a new CRL and manifest, but there's no point
+    in signing more than one of each per publication.  So rather than
+    generating these as we go, callers just note which ca_details need
+    them, and we generate each one once, right before calling pubd.
     """
 
     # At present, ._inplay and .inplay() are debugging tools only.  If
@@ -660,6 +706,7 @@ class publication_queue(object):
         self.msgs = {}
         self.handlers = {}
         self.uris = {}
+        self.ca_details = set()
 
     def inplay(self, uri):
         who = self._inplay.get(uri, self)
@@ -722,8 +769,74 @@ class publication_queue(object):
         self.uris[uri] = pdu
         self._inplay[uri] = self
 
+    def queue_crl_and_manifest(self, ca_detail):
+        """
+        Note that ca_detail needs a new CRL and manifest before we next
+        call pubd.  We only keep the primary key: the caller's copy may
+        be stale by the time we get around to generating.
+        """
+
+        logger.debug("Queuing CRL and manifest for %r", ca_detail)
+        self.ca_details.add(ca_detail.pk)
+
+    def savepoint(self):
+        """
+        Snapshot the queue so that .rollback() can discard anything
+        queued after this point.
+        """
+
+        return (dict(self.repositories), dict(self.handlers), dict(self.uris),
+                dict((rid, list(msg)) for rid, msg in self.msgs.iteritems()))
+
+    def rollback(self, savepoint):
+        """
+        Discard everything queued since .savepoint().
+        """
+
+        repositories, handlers, uris, msgs = savepoint
+        for uri in self.uris:
+            if uri not in uris and self._inplay.get(uri) is self:
+                del self._inplay[uri]
+        for rid in self.msgs.keys():
+            if rid in msgs:
+                self.msgs[rid][:] = msgs[rid]
+            else:
+                del self.msgs[rid]
+        self.repositories = repositories
+        self.handlers = handlers
+        self.uris = uris
+
+    def generate_crls_and_manifests(self):
+        """
+        Generate all the CRLs and manifests queued by
+        .queue_crl_and_manifest().  We load fresh copies from the
+        database, skipping ca_details which have since been revoked or
+        deleted: revocation generates its own final CRL and manifest
+        before discarding the keys.
+
+        Each ca_detail is generated in its own transaction; if one
+        fails, we roll back both its database changes and anything it
+        queued, and carry on with the rest.
+        """
+
+        from django.db import transaction
+
+        while self.ca_details:
+            pks = self.ca_details
+            self.ca_details = set()
+            q = rpki.rpkidb.models.CADetail.objects.select_related("ca__parent__repository")
+            for ca_detail in q.filter(pk__in = pks).exclude(state = "revoked"):
+                savepoint = self.savepoint()
+                try:
+                    with transaction.atomic():
+                        ca_detail.generate_crl_and_manifest(publisher = self)
+                except (rpki.exceptions.RPKI_Exception, rpki.POW.Error):
+                    logger.exception("Couldn't generate CRL and manifest for %r, skipping", ca_detail)
+                    self.rollback(savepoint)
+
     @tornado.gen.coroutine
     def call_pubd(self):
+        self.generate_crls_and_manifests()
         for rid in self.repositories:
             logger.debug("Calling pubd[%r]", self.repositories[rid])
             try:
@@ -792,4 +905,4 @@ class publication_queue(object):
         return sum(len(self.msgs[rid]) for rid in self.repositories)
 
     def empty(self):
-        return not self.msgs
+        return not self.msgs and not self.ca_details
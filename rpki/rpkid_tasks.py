@@ -22,6 +22,7 @@ rpkid task objects.  Split out from rpki.left_right and rpki.rpkid
 because interactions with rpkid scheduler were getting too complicated.
 """
 
+import time
 import logging
 import random
 
@@ -82,6 +83,7 @@ class AbstractTask(object):
         self.done_this   = None
         self.done_next   = None
         self.due_date    = None
+        self.queued      = None
         self.started     = False
         self.postponed   = False
         self.clear()
@@ -311,7 +313,7 @@ class UpdateChildrenTask(AbstractTask):
                     logger.debug("Resources shrank to null set, revoking and withdrawing child %s g(SKI) %s",
                                  child_handle, child_cert.gski)
                     child_cert.revoke(publisher = publisher)
-                    ca_detail.generate_crl_and_manifest(publisher = publisher)
+                    publisher.queue_crl_and_manifest(ca_detail)
 
                 elif (old_resources != new_resources or old_aia != new_aia or
                       (old_resources.valid_until < rsn and
@@ -338,7 +340,7 @@ class UpdateChildrenTask(AbstractTask):
                     publisher.queue(uri = child_cert.uri,
                                     old_obj = child_cert.cert,
                                     repository = ca_detail.ca.parent.repository)
-                    ca_detail.generate_crl_and_manifest(publisher = publisher)
+                    publisher.queue_crl_and_manifest(ca_detail)
 
             except:
                 logger.exception("%r: Couldn't update %r, skipping", self, child_cert)
@@ -371,10 +373,22 @@ class UpdateROAsTask(AbstractTask):
     # fairly low given that we defer CRL and manifest generation until
     # we're ready to publish, but it's theoretically present.
 
+    ## @var batch_size
+    # How many ROAs to update per database transaction.  We only check
+    # whether we're overdue between batches, since yielding to the
+    # task loop in the middle of a transaction would let other tasks'
+    # database writes wander into it.
+
+    batch_size = 100
+
     @tornado.gen.coroutine
     def main(self):
+        from django.db import transaction
+
         logger.debug("%r: Updating ROAs", self)
 
+        t0 = time.time()
+
         try:
             r_msg = yield self.rpkid.irdb_query_roa_requests(self.tenant.tenant_handle)
         except:
@@ -391,7 +405,24 @@ class UpdateROAsTask(AbstractTask):
         publisher = rpki.rpkid.publication_queue(self.rpkid)
         ca_details = set()
 
-        for roa in self.tenant.roas.all():
+        # Load every ROA with its ca_detail in one query, then make
+        # ROAs with the same ca_detail share one instance of it (and of
+        # the tenant) so that checking each ROA costs no further queries
+        # and each CA certificate only gets parsed once.  The shared
+        # instances are only good until we next yield: other handlers
+        # may allocate serial or CRL numbers from the same CA while
+        # we're suspended, so we reload them after every yield.
+
+        existing = list(self.tenant.roas.select_related("ca_detail__ca__parent__repository"))
+        shared = {}
+        for roa in existing:
+            roa.tenant = self.tenant
+            if roa.ca_detail_id is not None:
+                roa.ca_detail = shared.setdefault(roa.ca_detail_id, roa.ca_detail)
+
+        t1 = time.time()
+
+        for roa in existing:
             k = "{!s} {!s} {!s}".format(roa.asn, roa.ipv4, roa.ipv6)
             if k not in roas:
                 roas[k] = roa
@@ -418,9 +449,14 @@ class UpdateROAsTask(AbstractTask):
 
         orphans.extend(roas.itervalues())
 
+        logger.debug("%r: %d ROA(s) to create, %d to check, %d to revoke",
+                     self, len(creates), len(updates), len(orphans))
+
         roas = creates + updates
 
-        r_msg = seen = creates = updates = None
+        r_msg = seen = creates = updates = existing = None
+
+        t2 = time.time()
 
         postponing = False
 
@@ -428,32 +464,68 @@ class UpdateROAsTask(AbstractTask):
             if (yield self.overdue()):
                 postponing = True
                 break
-            roa = roas.pop(0)
-            try:
-                roa.update(publisher = publisher)
-                ca_details.add(roa.ca_detail.pk)
-            except rpki.exceptions.NoCoveringCertForROA:
-                logger.warning("%r: No covering certificate for %r, skipping", self, roa)
-            except:
-                logger.exception("%r: Could not update %r, skipping", self, roa)
+            batch, roas = roas[:self.batch_size], roas[self.batch_size:]
+            shared = self.reload_ca_details(shared, batch)
+            with transaction.atomic():
+                for roa in batch:
+                    try:
+                        with transaction.atomic():
+                            roa.update(publisher = publisher)
+                        ca_details.add(roa.ca_detail.pk)
+                    except rpki.exceptions.NoCoveringCertForROA:
+                        logger.warning("%r: No covering certificate for %r, skipping", self, roa)
+                    except:
+                        logger.exception("%r: Could not update %r, skipping", self, roa)
+
+        t3 = time.time()
 
         if not postponing:
-            for roa in orphans:
-                try:
-                    ca_details.add(roa.ca_detail.pk)
-                    roa.revoke(publisher = publisher)
-                except:
-                    logger.exception("%r: Could not revoke %r", self, roa)
+            shared = self.reload_ca_details(shared, orphans)
+            with transaction.atomic():
+                for roa in orphans:
+                    try:
+                        with transaction.atomic():
+                            ca_details.add(roa.ca_detail.pk)
+                            roa.revoke(publisher = publisher)
+                    except:
+                        logger.exception("%r: Could not revoke %r", self, roa)
+
+        t4 = time.time()
 
         if not publisher.empty():
             for ca_detail in rpki.rpkidb.models.CADetail.objects.filter(pk__in = ca_details):
-                logger.debug("%r: Generating new CRL and manifest for %r", self, ca_detail)
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                publisher.queue_crl_and_manifest(ca_detail)
             yield publisher.call_pubd()
 
+        t5 = time.time()
+
+        logger.debug("%r: ROA timings: load %.3f, reconcile %.3f, update %.3f, revoke %.3f, publish %.3f seconds",
+                     self, t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)
+
         if postponing:
             raise PostponeTask
 
+    @staticmethod
+    def reload_ca_details(shared, roas):
+        """
+        Replace our shared ca_detail instances, and the CA instances
+        hanging off them, with fresh copies from SQL, and point roas
+        at the fresh copies.  ROAs whose ca_detail has vanished lose
+        their cached copy, so that they find out the same way they
+        would have if we'd never cached anything.
+        """
+
+        shared = dict((ca_detail.pk, ca_detail) for ca_detail in
+                      rpki.rpkidb.models.CADetail.objects.filter(pk__in = shared.keys())
+                      .select_related("ca__parent__repository"))
+        cache_name = rpki.rpkidb.models.ROA._meta.get_field("ca_detail").get_cache_name()
+        for roa in roas:
+            if roa.ca_detail_id in shared:
+                roa.ca_detail = shared[roa.ca_detail_id]
+            elif hasattr(roa, cache_name):
+                delattr(roa, cache_name)
+        return shared
+
 
 @queue_task
 class UpdateGhostbustersTask(AbstractTask):
@@ -515,7 +587,7 @@ class UpdateGhostbustersTask(AbstractTask):
                 ghostbuster.revoke(publisher = publisher)
 
             for ca_detail in ca_details:
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                publisher.queue_crl_and_manifest(ca_detail)
 
             yield publisher.call_pubd()
 
@@ -609,7 +681,7 @@ class UpdateEECertificatesTask(AbstractTask):
                     ee.revoke(publisher = publisher)
 
             for ca_detail in ca_details:
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                publisher.queue_crl_and_manifest(ca_detail)
 
             yield publisher.call_pubd()
 
@@ -649,7 +721,7 @@ class RegenerateCRLsAndManifestsTask(AbstractTask):
                                                next_crl_manifest_update__lt = now + max(
                                                    rpki.sundial.timedelta(seconds = self.tenant.crl_interval) / 4,
                                                    rpki.sundial.timedelta(seconds = self.rpkid.cron_period  ) * 2)):
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                publisher.queue_crl_and_manifest(ca_detail)
 
             yield publisher.call_pubd()
 
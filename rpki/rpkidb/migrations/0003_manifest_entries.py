@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpkidb', '0002_root'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='childcert',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='eecertificate',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='ghostbuster',
+            name='gski',
+            field=models.CharField(max_length=27, null=True),
+        ),
+        migrations.AddField(
+            model_name='ghostbuster',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='roa',
+            name='gski',
+            field=models.CharField(max_length=27, null=True),
+        ),
+        migrations.AddField(
+            model_name='roa',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
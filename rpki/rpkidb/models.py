@@ -19,6 +19,7 @@ Django ORM models for rpkid.
 
 from __future__ import unicode_literals
 
+import bisect
 import logging
 
 import tornado.gen
@@ -410,18 +411,11 @@ class Tenant(models.Model):
         """
         Return all active CADetails for this <tenant/> which cover a
         particular set of resources.
-
-        If we expected there to be a large number of CADetails, we
-        could add index tables and write fancy SQL query to do this, but
-        for the expected common case where there are only one or two
-        active CADetails per <tenant/>, it's probably not worth it.  In
-        any case, this is an optimization we can leave for later.
         """
 
         trace_call_chain()
-        return set(ca_detail
-                   for ca_detail in CADetail.objects.filter(ca__parent__tenant = self, state = "active")
-                   if ca_detail.covers(resources))
+        pks = CoveringIndex.get(self.pk).find(resources)
+        return set(CADetail.objects.filter(pk__in = pks, state = "active"))
 
 
 @xml_hooks
@@ -525,11 +519,12 @@ class Repository(models.Model):
             handlers = {}
         for q_pdu in q_msg:
             logger.info("Sending %r hash = %s uri = %s to pubd", q_pdu, q_pdu.get("hash"), q_pdu.get("uri"))
+        q_der = yield rpki.publication.cms_msg().wrap_async(q_msg, self.bsc.private_key_id,
+                                                            self.bsc.signing_cert, self.bsc.signing_cert_crl)
         http_request = tornado.httpclient.HTTPRequest(
             url             = self.peer_contact_uri,
             method          = "POST",
-            body            = rpki.publication.cms_msg().wrap(q_msg, self.bsc.private_key_id,
-                                                              self.bsc.signing_cert, self.bsc.signing_cert_crl),
+            body            = q_der,
             headers         = { "Content-Type" : rpki.publication.content_type },
             connect_timeout = rpkid.http_client_timeout,
             request_timeout = rpkid.http_client_timeout)
@@ -538,7 +533,7 @@ class Repository(models.Model):
             raise rpki.exceptions.BadContentType("HTTP Content-Type %r, expected %r" % (
                 rpki.publication.content_type, http_response.headers.get("Content-Type")))
         r_cms = rpki.publication.cms_msg(DER = http_response.body)
-        r_msg = r_cms.unwrap((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
+        r_msg = yield r_cms.unwrap_async((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
         r_cms.check_replay_sql(self, self.peer_contact_uri)
         for r_pdu in r_msg:
             logger.info("Received %r hash = %s uri = %s from pubd", r_pdu, r_pdu.get("hash"), r_pdu.get("uri"))
@@ -771,12 +766,13 @@ class Parent(models.Model):
         elif self.bsc.signing_cert is None:
             raise rpki.exceptions.BSCNotReady("%r is not yet usable" % self.bsc)
         else:
+            q_der = yield rpki.up_down.cms_msg().wrap_async(q_msg, self.bsc.private_key_id,
+                                                            self.bsc.signing_cert,
+                                                            self.bsc.signing_cert_crl)
             http_request = tornado.httpclient.HTTPRequest(
                 url             = self.peer_contact_uri,
                 method          = "POST",
-                body            = rpki.up_down.cms_msg().wrap(q_msg, self.bsc.private_key_id,
-                                                              self.bsc.signing_cert,
-                                                              self.bsc.signing_cert_crl),
+                body            = q_der,
                 headers         = { "Content-Type" : rpki.up_down.content_type },
                 connect_timeout = rpkid.http_client_timeout,
                 request_timeout = rpkid.http_client_timeout)
@@ -785,9 +781,9 @@ class Parent(models.Model):
                 raise rpki.exceptions.BadContentType("HTTP Content-Type %r, expected %r" % (
                     rpki.up_down.content_type, http_response.headers.get("Content-Type")))
             r_cms = rpki.up_down.cms_msg(DER = http_response.body)
-            r_msg = r_cms.unwrap((rpkid.bpki_ta,
-                                  self.tenant.bpki_cert, self.tenant.bpki_glue,
-                                  self.bpki_cert, self.bpki_glue))
+            r_msg = yield r_cms.unwrap_async((rpkid.bpki_ta,
+                                              self.tenant.bpki_cert, self.tenant.bpki_glue,
+                                              self.bpki_cert, self.bpki_glue))
             r_cms.check_replay_sql(self, self.peer_contact_uri)
         #logger.debug("%r query_up_down(): %s", self, ElementToString(r_msg))
         rpki.up_down.check_response(r_msg, q_msg.get("type"))
@@ -1144,6 +1140,99 @@ class CA(models.Model):
             yield ca_detail.reissue(rpkid = rpkid)
 
 
+class CoveringIndex(object):
+    """
+    Per-tenant interval index from resources to the tenant's active
+    CADetails, so that finding a covering certificate takes a binary
+    search per resource range rather than parsing every CA certificate
+    the tenant holds.  Indexes are built on demand and discarded when a
+    CADetail they depend on changes state or certificate.  Callers
+    should still check state in SQL, since deletions can happen
+    behind our back.
+    """
+
+    _indexes = {}                       # tenant pk -> CoveringIndex
+    _owners  = {}                       # ca_detail pk -> tenant pk
+
+    def __init__(self, tenant_id):
+        self.tenant_id = tenant_id
+        self.certs     = {}             # ca_detail pk -> DER of CA cert
+        self.expires   = {}             # ca_detail pk -> notAfter of CA cert
+        ranges = dict(asn = [], v4 = [], v6 = [])
+        for ca_detail in CADetail.objects.filter(ca__parent__tenant = tenant_id, state = "active"):
+            cert = ca_detail.latest_ca_cert
+            if cert is None:
+                continue
+            self.certs[ca_detail.pk]   = cert.get_DER()
+            self.expires[ca_detail.pk] = cert.getNotAfter()
+            resources = cert.get_3779resources()
+            for family in ranges:
+                ranges[family].extend((rng.min, rng.max, ca_detail.pk) for rng in getattr(resources, family))
+        self.families = dict((family, self.build(ranges[family])) for family in ranges)
+
+    @staticmethod
+    def build(ranges):
+        """
+        Split the number line at every range boundary, and record for
+        each resulting segment which ca_details cover it and where
+        each such ca_detail's covering range ends.  Segment i runs from
+        points[i] up to but not including points[i + 1].
+        """
+
+        points = sorted(set(lo for lo, hi, pk in ranges) | set(hi + 1 for lo, hi, pk in ranges))
+        segments = [dict() for point in points]
+        for lo, hi, pk in ranges:
+            for i in xrange(bisect.bisect_left(points, lo), bisect.bisect_left(points, hi + 1)):
+                segments[i][pk] = hi
+        return points, segments
+
+    def find(self, resources, now = None):
+        """
+        Return primary keys of ca_details covering resources, and
+        (if now is specified) not yet expired.
+        """
+
+        assert not resources.asn.inherit and not resources.v4.inherit and not resources.v6.inherit
+        candidates = set(self.certs)
+        for family, (points, segments) in self.families.iteritems():
+            for rng in getattr(resources, family):
+                i = bisect.bisect_right(points, rng.min) - 1
+                covering = segments[i] if i >= 0 else {}
+                candidates.intersection_update([pk for pk, hi in covering.iteritems() if hi >= rng.max])
+        if now is not None:
+            candidates = set(pk for pk in candidates if self.expires[pk] > now)
+        return candidates
+
+    @classmethod
+    def get(cls, tenant_id):
+        self = cls._indexes.get(tenant_id)
+        if self is None:
+            self = cls._indexes[tenant_id] = cls(tenant_id)
+            cls._owners.update((pk, tenant_id) for pk in self.certs)
+        return self
+
+    @classmethod
+    def discard(cls, tenant_id):
+        self = cls._indexes.pop(tenant_id, None)
+        if self is not None:
+            for pk in self.certs:
+                cls._owners.pop(pk, None)
+
+    @classmethod
+    def changed(cls, ca_detail):
+        """
+        Discard any index which this change to ca_detail might affect.
+        """
+
+        tenant_id = cls._owners.get(ca_detail.pk)
+        if tenant_id is not None:
+            cert = ca_detail.latest_ca_cert
+            if ca_detail.state != "active" or cert is None or cert.get_DER() != cls._indexes[tenant_id].certs[ca_detail.pk]:
+                cls.discard(tenant_id)
+        elif ca_detail.state == "active" and cls._indexes:
+            cls.discard(ca_detail.ca.parent.tenant_id)
+
+
 class CADetail(models.Model):
     public_key = PublicKeyField(null = True)
     private_key_id = RSAPrivateKeyField(null = True)
@@ -1170,6 +1259,18 @@ class CADetail(models.Model):
             return "<CADetail: CADetail object>"
 
 
+    def save(self, *args, **kwargs):
+        super(CADetail, self).save(*args, **kwargs)
+        CoveringIndex.changed(self)
+
+
+    def delete(self, *args, **kwargs):
+        tenant_id = CoveringIndex._owners.get(self.pk)
+        super(CADetail, self).delete(*args, **kwargs)
+        if tenant_id is not None:
+            CoveringIndex.discard(tenant_id)
+
+
     @property
     def crl_uri(self):
         """
@@ -1228,7 +1329,7 @@ class CADetail(models.Model):
         self.latest_ca_cert = cert
         self.ca_cert_uri = uri
         self.state = "active"
-        self.generate_crl_and_manifest(publisher = publisher)
+        publisher.queue_crl_and_manifest(self)
         self.save()
 
         if predecessor is not None:
@@ -1242,7 +1343,7 @@ class CADetail(models.Model):
                 ghostbuster.regenerate(publisher = publisher)
             for eecert in predecessor.ee_certificates.all():
                 eecert.reissue(publisher = publisher, ca_detail = self)
-            predecessor.generate_crl_and_manifest(publisher = publisher)
+            publisher.queue_crl_and_manifest(predecessor)
 
         yield publisher.call_pubd()
 
@@ -1309,7 +1410,7 @@ class CADetail(models.Model):
         if self.latest_ca_cert != cert:
             self.latest_ca_cert = cert
             self.save()
-            self.generate_crl_and_manifest(publisher = publisher)
+            publisher.queue_crl_and_manifest(self)
 
         new_resources = self.latest_ca_cert.get_3779resources()
 
@@ -1392,7 +1493,7 @@ class CADetail(models.Model):
             new_obj    = child_cert.cert,
             repository = ca.parent.repository,
             handler    = child_cert.published_callback)
-        self.generate_crl_and_manifest(publisher = publisher)
+        publisher.queue_crl_and_manifest(self)
         return child_cert
 
 
@@ -1430,13 +1531,8 @@ class CADetail(models.Model):
             sia         = (None, None, manifest_uri, self.ca.parent.repository.rrdp_notification_uri),
             notBefore   = now)
 
-        certlist = []
-        for revoked_cert in self.revoked_certs.all():
-            if now > revoked_cert.expires + crl_interval:
-                revoked_cert.delete()
-            else:
-                certlist.append((revoked_cert.serial, revoked_cert.revoked))
-        certlist.sort()
+        self.revoked_certs.filter(expires__lt = now - crl_interval).delete()
+        certlist = list(self.revoked_certs.order_by("serial").values_list("serial", "revoked"))
 
         self.latest_crl = rpki.x509.CRL.generate(
             keypair             = self.private_key_id,
@@ -1446,25 +1542,18 @@ class CADetail(models.Model):
             nextUpdate          = nextUpdate,
             revokedCertificates = certlist)
 
-        # XXX
-        logger.debug("%r Generating manifest, child_certs_all(): %r", self, self.child_certs.all())
-
-        objs = [(self.crl_uri_tail, self.latest_crl)]
-        objs.extend((c.uri_tail, c.cert)        for c in self.child_certs.all())
-        objs.extend((r.uri_tail, r.roa)         for r in self.roas.filter(roa__isnull = False))
-        objs.extend((g.uri_tail, g.ghostbuster) for g in self.ghostbusters.all())
-        objs.extend((e.uri_tail, e.cert)        for e in self.ee_certificates.all())
+        entries = list(self.manifest_entries())
 
-        # XXX
-        logger.debug("%r Generating manifest, objs: %r", self, objs)
+        logger.debug("%r Generating manifest, %d entries plus CRL", self, len(entries))
 
         self.latest_manifest = rpki.x509.SignedManifest.build(
-            serial         = crl_manifest_number,
-            thisUpdate     = now,
-            nextUpdate     = nextUpdate,
-            names_and_objs = objs,
-            keypair        = self.manifest_private_key_id,
-            certs          = manifest_cert)
+            serial           = crl_manifest_number,
+            thisUpdate       = now,
+            nextUpdate       = nextUpdate,
+            names_and_objs   = [(self.crl_uri_tail, self.latest_crl)],
+            names_and_hashes = entries,
+            keypair          = self.manifest_private_key_id,
+            certs            = manifest_cert)
 
         self.crl_published      = now
         self.manifest_published = now
@@ -1486,6 +1575,27 @@ class CADetail(models.Model):
             handler    = self.manifest_published_callback)
 
 
+    def manifest_entries(self):
+        """
+        Generate filenames and SHA-256 digests of everything this
+        ca_detail has issued, for the manifest.  Each product records
+        its g(SKI) and hash when saved, so this is just a query per
+        product table; rows saved before we recorded these get fixed
+        up as we go.
+        """
+
+        for q, suffix in ((self.child_certs.all(),                 ".cer"),
+                          (self.roas.filter(roa__isnull = False),  ".roa"),
+                          (self.ghostbusters.all(),                ".gbr"),
+                          (self.ee_certificates.all(),             ".cer")):
+            for pk, gski, sha256 in q.values_list("pk", "gski", "sha256"):
+                if gski is None or sha256 is None:
+                    obj = q.model.objects.get(pk = pk)
+                    obj.save()
+                    gski, sha256 = obj.gski, obj.sha256
+                yield gski + suffix, sha256.decode("hex")
+
+
     def crl_published_callback(self, pdu):
         """
         Check result of CRL publication.
@@ -1524,7 +1634,7 @@ class CADetail(models.Model):
             ee_certificate.reissue(publisher, force = True)
         for child_cert in self.child_certs.all():
             child_cert.reissue(self, publisher, force = True)
-        self.generate_crl_and_manifest(publisher = publisher)
+        publisher.queue_crl_and_manifest(self)
         self.save()
         yield publisher.call_pubd()
 
@@ -1638,7 +1748,7 @@ class Child(models.Model):
             ca_details.add(child_cert.ca_detail)
             child_cert.revoke(publisher = publisher)
         for ca_detail in ca_details:
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
+            publisher.queue_crl_and_manifest(ca_detail)
         yield publisher.call_pubd()
 
 
@@ -1777,7 +1887,7 @@ class Child(models.Model):
             ca_details.add(child_cert.ca_detail)
             child_cert.revoke(publisher = publisher)
         for ca_detail in ca_details:
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
+            publisher.queue_crl_and_manifest(ca_detail)
         yield publisher.call_pubd()
         SubElement(r_msg, key.tag, class_name = class_name, ski = key.get("ski"))
 
@@ -1794,7 +1904,7 @@ class Child(models.Model):
             raise rpki.exceptions.BSCNotFound("Could not find BSC")
 
         q_cms = rpki.up_down.cms_msg(DER = q_der)
-        q_msg = q_cms.unwrap((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
+        q_msg = yield q_cms.unwrap_async((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
         q_cms.check_replay_sql(self, "child", self.child_handle)
         q_type = q_msg.get("type")
 
@@ -1814,13 +1924,14 @@ class Child(models.Model):
             logger.exception("Unhandled exception serving child %r", self)
             rpki.up_down.generate_error_response_from_exception(r_msg, e, q_type)
 
-        r_der = rpki.up_down.cms_msg().wrap(r_msg, self.bsc.private_key_id, self.bsc.signing_cert, self.bsc.signing_cert_crl)
+        r_der = yield rpki.up_down.cms_msg().wrap_async(r_msg, self.bsc.private_key_id, self.bsc.signing_cert, self.bsc.signing_cert_crl)
         raise tornado.gen.Return(r_der)
 
 class ChildCert(models.Model):
     cert = CertificateField()
     published = SundialField(null = True)
     gski = models.CharField(max_length = 27)      # Assumes SHA-1 -- SHA-256 would be 43, SHA-512 would be 86, etc.
+    sha256 = models.CharField(max_length = 64, null = True) # hex SHA-256 of cert, for manifests
     child = models.ForeignKey(Child, related_name = "child_certs")
     ca_detail = models.ForeignKey(CADetail, related_name = "child_certs")
 
@@ -1842,6 +1953,11 @@ class ChildCert(models.Model):
         return self.gski + ".cer"
 
 
+    def save(self, *args, **kwargs):
+        self.sha256 = rpki.x509.sha256(self.cert.get_DER()).encode("hex")
+        super(ChildCert, self).save(*args, **kwargs)
+
+
     @property
     def uri(self):
         """
@@ -1921,7 +2037,7 @@ class ChildCert(models.Model):
             for child_cert in child.child_certs.filter(ca_detail = ca_detail, gski = self.gski):
                 logger.debug("Revoking %r", child_cert)
                 child_cert.revoke(publisher = publisher)
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
+            publisher.queue_crl_and_manifest(ca_detail)
         child_cert = ca_detail.issue(
             ca          = ca,
             child       = child,
@@ -1947,6 +2063,7 @@ class ChildCert(models.Model):
 
 class EECertificate(models.Model):
     gski = models.CharField(max_length = 27)      # Assumes SHA-1 -- SHA-256 would be 43, SHA-512 would be 86, etc.
+    sha256 = models.CharField(max_length = 64, null = True) # hex SHA-256 of cert, for manifests
     cert = CertificateField()
     published = SundialField(null = True)
     tenant = models.ForeignKey(Tenant, related_name = "ee_certificates")
@@ -1979,6 +2096,11 @@ class EECertificate(models.Model):
         return self.gski + ".cer"
 
 
+    def save(self, *args, **kwargs):
+        self.sha256 = rpki.x509.sha256(self.cert.get_DER()).encode("hex")
+        super(EECertificate, self).save(*args, **kwargs)
+
+
     def revoke(self, publisher):
         """
         Revoke and withdraw an EE certificate.
@@ -2054,7 +2176,7 @@ class EECertificate(models.Model):
             handler    = self.published_callback)
         if must_revoke:
             RevokedCert.revoke(cert = old_cert.cert, ca_detail = old_ca_detail)
-        ca_detail.generate_crl_and_manifest(publisher = publisher)
+        publisher.queue_crl_and_manifest(ca_detail)
 
 
     def published_callback(self, pdu):
@@ -2073,6 +2195,8 @@ class Ghostbuster(models.Model):
     vcard = models.TextField()
     cert = CertificateField()
     ghostbuster = GhostbusterField()
+    gski = models.CharField(max_length = 27, null = True) # g(SKI) of cert, for manifests
+    sha256 = models.CharField(max_length = 64, null = True) # hex SHA-256 of ghostbuster, for manifests
     published = SundialField(null = True)
     tenant = models.ForeignKey(Tenant, related_name = "ghostbusters")
     ca_detail = models.ForeignKey(CADetail, related_name = "ghostbusters")
@@ -2223,6 +2347,12 @@ class Ghostbuster(models.Model):
         return self.cert.gSKI() + ".gbr"
 
 
+    def save(self, *args, **kwargs):
+        self.gski   = None if self.cert        is None else self.cert.gSKI()
+        self.sha256 = None if self.ghostbuster is None else rpki.x509.sha256(self.ghostbuster.get_DER()).encode("hex")
+        super(Ghostbuster, self).save(*args, **kwargs)
+
+
 class RevokedCert(models.Model):
     serial = models.BigIntegerField()
     revoked = SundialField()
@@ -2263,6 +2393,8 @@ class ROA(models.Model):
     ipv6 = models.TextField(null = True)
     cert = CertificateField()
     roa = ROAField()
+    gski = models.CharField(max_length = 27, null = True) # g(SKI) of cert, for manifests
+    sha256 = models.CharField(max_length = 64, null = True) # hex SHA-256 of roa, for manifests
     published = SundialField(null = True)
     tenant = models.ForeignKey(Tenant, related_name = "roas")
     ca_detail = models.ForeignKey(CADetail, related_name = "roas")
@@ -2334,11 +2466,8 @@ class ROA(models.Model):
         """
         Generate a ROA.
 
-        At present we have no way of performing a direct lookup from a
-        desired set of resources to a covering certificate, so we have to
-        search.  This could be quite slow if we have a lot of active
-        ca_detail objects.  Punt on the issue for now, revisit if
-        profiling shows this as a hotspot.
+        If the ROA's current ca_detail is no longer usable, we look up
+        a covering certificate in the tenant's CoveringIndex.
 
         Once we have the right covering certificate, we generate the ROA
         payload, generate a new EE certificate, use the EE certificate to
@@ -2355,6 +2484,7 @@ class ROA(models.Model):
 
         v4 = rpki.resource_set.roa_prefix_set_ipv4(self.ipv4).to_resource_set()
         v6 = rpki.resource_set.roa_prefix_set_ipv6(self.ipv6).to_resource_set()
+        resources = rpki.resource_set.resource_bag(v4 = v4, v6 = v6)
 
         # http://stackoverflow.com/questions/26270042/how-do-you-catch-this-exception
         # "Django is amazing when its not terrifying."
@@ -2367,16 +2497,13 @@ class ROA(models.Model):
             logger.debug("Keeping old ca_detail %r for ROA %r", ca_detail, self)
         else:
             logger.debug("Searching for new ca_detail for ROA %r", self)
-            for ca_detail in CADetail.objects.filter(ca__parent__tenant = self.tenant, state = "active"):
-                resources = ca_detail.latest_ca_cert.get_3779resources()
-                if not ca_detail.has_expired() and v4.issubset(resources.v4) and v6.issubset(resources.v6):
-                    logger.debug("Using %r for ROA %r", ca_detail, self)
-                    self.ca_detail = ca_detail
-                    break
-            else:
+            pks = CoveringIndex.get(self.tenant_id).find(resources, now = rpki.sundial.now())
+            ca_detail = CADetail.objects.filter(pk__in = pks, state = "active").order_by("pk").first()
+            if ca_detail is None:
                 raise rpki.exceptions.NoCoveringCertForROA("Could not find a certificate covering %r" % self)
+            logger.debug("Using %r for ROA %r", ca_detail, self)
+            self.ca_detail = ca_detail
 
-        resources = rpki.resource_set.resource_bag(v4 = v4, v6 = v6)
         keypair = rpki.x509.RSA.generate()
 
         self.cert = self.ca_detail.issue_ee(
@@ -2479,3 +2606,9 @@ class ROA(models.Model):
         """
 
         return self.cert.gSKI() + ".roa"
+
+
+    def save(self, *args, **kwargs):
+        self.gski   = None if self.cert is None else self.cert.gSKI()
+        self.sha256 = None if self.roa  is None else rpki.x509.sha256(self.roa.get_DER()).encode("hex")
+        super(ROA, self).save(*args, **kwargs)
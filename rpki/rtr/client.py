@@ -24,6 +24,7 @@ import os
 import sys
 import base64
 import socket
+import itertools
 import signal
 import logging
 import asyncore
@@ -187,6 +188,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.args = args
         self.host = args.host if host is None else host
         self.port = args.port if port is None else port
+        self.sql_queue = []
         super(ClientChannel, self).__init__(sock = sock, root_pdu_class = PDU)
         if args.force_version is not None:
             self.version = args.force_version
@@ -286,6 +288,8 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.sql.text_factory = str
         cur = self.sql.cursor()
         cur.execute("PRAGMA foreign_keys = on")
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = NORMAL")
         if missing:
             cur.execute('''
                 CREATE TABLE cache (
@@ -356,6 +360,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         """
 
         self.serial = None
+        del self.sql_queue[:]
         if self.sql:
             cur = self.sql.cursor()
             cur.execute("DELETE FROM prefix WHERE cache_id = ?", (self.cache_id,))
@@ -376,6 +381,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.expire  = expire
         self.updated = Timestamp.now()
         if self.sql:
+            self.flush_sql_queue()
             self.sql.execute("UPDATE cache SET"
                              " version = ?, serial = ?, nonce  = ?,"
                              " refresh = ?, retry  = ?, expire = ?,"
@@ -392,13 +398,13 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         if self.sql:
             values = (self.cache_id, prefix.asn, str(prefix.prefix), prefix.prefixlen, prefix.max_prefixlen)
             if prefix.announce:
-                self.sql.execute("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
-                                 "VALUES (?, ?, ?, ?, ?)",
-                                 values)
+                self.sql_queue.append(("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
+                                       "VALUES (?, ?, ?, ?, ?)",
+                                       values))
             else:
-                self.sql.execute("DELETE FROM prefix "
-                                 "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
-                                 values)
+                self.sql_queue.append(("DELETE FROM prefix "
+                                       "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
+                                       values))
 
     def consume_routerkey(self, routerkey):
         """
@@ -410,13 +416,25 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
                       base64.urlsafe_b64encode(routerkey.ski).rstrip("="),
                       base64.b64encode(routerkey.key))
             if routerkey.announce:
-                self.sql.execute("INSERT INTO routerkey (cache_id, asn, ski, key) "
-                                 "VALUES (?, ?, ?, ?)",
-                                 values)
+                self.sql_queue.append(("INSERT INTO routerkey (cache_id, asn, ski, key) "
+                                       "VALUES (?, ?, ?, ?)",
+                                       values))
             else:
-                self.sql.execute("DELETE FROM routerkey "
-                                 "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
-                                 values)
+                self.sql_queue.append(("DELETE FROM routerkey "
+                                       "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
+                                       values))
+
+    def flush_sql_queue(self):
+        """
+        Apply queued prefix and router key changes from the current cache
+        response.  Consecutive changes using the same statement go to
+        SQLite as one executemany(), preserving the order in which the
+        cache sent them; caller commits.
+        """
+
+        for statement, changes in itertools.groupby(self.sql_queue, lambda change: change[0]):
+            self.sql.executemany(statement, (change[1] for change in changes))
+        del self.sql_queue[:]
 
     def deliver_pdu(self, pdu):
         """
@@ -23,7 +23,9 @@ Database generator for RPKI-RTR server (RFC 6810 et sequalia).
 
 import os
 import sys
+import mmap
 import glob
+import struct
 import socket
 import base64
 import random
@@ -245,24 +247,37 @@ class AXFRSet(PDUSet):
 
         self = cls(version = version)
         self.serial = rpki.rtr.channels.Timestamp.now()
+        self.extend(cls._rcynic_pdus(rcynic_dir, version, scan_roas, scan_routercerts))
+        self.sort()
+        for i in xrange(len(self) - 2, -1, -1):
+            if self[i] == self[i + 1]:
+                del self[i + 1]
+        return self
+
+    @staticmethod
+    def _rcynic_pdus(rcynic_dir, version, scan_roas, scan_routercerts):
+        """
+        Generate prefix and router key PDUs from rcynic's output, in no
+        particular order and possibly with duplicates.
+        """
 
         include_routercerts = RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]
 
         if scan_roas is None:
-            for uri, roa in authenticated_objects(rcynic_dir, uri_suffix = ".roa", class_map = self.class_map):
+            for uri, roa in authenticated_objects(rcynic_dir, uri_suffix = ".roa", class_map = AXFRSet.class_map):
                 roa.extractWithoutVerifying()
                 asn = roa.getASID()
-                self.extend(PrefixPDU.from_roa(version = version, asn = asn, prefix_tuple = prefix_tuple)
-                            for prefix_tuple in roa.prefixes)
+                for prefix_tuple in roa.prefixes:
+                    yield PrefixPDU.from_roa(version = version, asn = asn, prefix_tuple = prefix_tuple)
 
         if scan_routercerts is None and include_routercerts:
-            for uri, cer in authenticated_objects(rcynic_dir, uri_suffix = ".cer", class_map = self.class_map):
+            for uri, cer in authenticated_objects(rcynic_dir, uri_suffix = ".cer", class_map = AXFRSet.class_map):
                 eku = cer.getEKU()
                 if eku is not None and rpki.oids.id_kp_bgpsec_router in eku:
                     ski = cer.getSKI()
                     key = cer.getPublicKey().derWritePublic()
-                    self.extend(RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key)
-                                for asn in cer.asns)
+                    for asn in cer.asns:
+                        yield RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key)
 
         if scan_roas is not None:
             try:
@@ -270,8 +285,8 @@ class AXFRSet(PDUSet):
                 for line in p.stdout:
                     line = line.split()
                     asn = line[1]
-                    self.extend(PrefixPDU.from_text(version = version, asn = asn, addr = addr)
-                                for addr in line[2:])
+                    for addr in line[2:]:
+                        yield PrefixPDU.from_text(version = version, asn = asn, addr = addr)
             except OSError, e:
                 sys.exit("Could not run %s: %s" % (scan_roas, e))
 
@@ -282,17 +297,11 @@ class AXFRSet(PDUSet):
                     line = line.split()
                     gski = line[0]
                     key  = line[-1]
-                    self.extend(RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
-                                for asn in line[1:-1])
+                    for asn in line[1:-1]:
+                        yield RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
             except OSError, e:
                 sys.exit("Could not run %s: %s" % (scan_routercerts, e))
 
-        self.sort()
-        for i in xrange(len(self) - 2, -1, -1):
-            if self[i] == self[i + 1]:
-                del self[i + 1]
-        return self
-
     @classmethod
     def load(cls, filename):
         """
@@ -463,6 +472,190 @@ class IXFRSet(PDUSet):
             logging.debug(p)
 
 
+class PackedPDUSet(object):
+    """
+    Mixin for compact PDU sets, used by the cronjob.  Instead of PDU
+    objects, these hold the wire format of each PDU as a string, which
+    is what we write to disk anyway and is an order of magnitude
+    smaller in memory than the PDU objects.
+
+    Since PDUs are ordered by their wire format, sorting, comparing,
+    and diffing sets of PDUs all reduce to operations on lists and sets
+    of strings, which Python does in C rather than one PDU at a time.
+    Loading is cheap too: our files are just concatenated wire format,
+    so we mmap() them and slice them up by the PDU length fields.
+    """
+
+    # Length field is at the same offset in every PDU header.
+    length_struct = struct.Struct("!L")
+    length_offset = 4
+
+    # Offset of the announce flag depends on the PDU type.
+    flags_offset = { IPv4PrefixPDU.pdu_type : 8,
+                     IPv6PrefixPDU.pdu_type : 8,
+                     RouterKeyPDU.pdu_type  : 2 }
+
+    @classmethod
+    def _load_file(cls, filename, version):
+        """
+        Load wire format PDUs from a file.
+        """
+
+        self = cls(version = version)
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return self
+            m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                i = 0
+                n = len(m)
+                unpack_from = cls.length_struct.unpack_from
+                while i < n:
+                    length = unpack_from(m, i + cls.length_offset)[0]
+                    if length < 8 or i + length > n:
+                        raise rpki.rtr.pdus.CorruptData("Bad PDU length %d at offset %d in %s" % (length, i, filename))
+                    self.append(m[i : i + length])
+                    i += length
+            finally:
+                m.close()
+        return self
+
+    @classmethod
+    def get_announce(cls, pdu):
+        """
+        Extract the announce flag from the wire format of a PDU.
+        """
+
+        return ord(pdu[cls.flags_offset[ord(pdu[1])]])
+
+    @classmethod
+    def set_announce(cls, pdu, announce):
+        """
+        Return the wire format of a PDU with its announce flag changed.
+        """
+
+        i = cls.flags_offset[ord(pdu[1])]
+        return pdu[:i] + chr(announce) + pdu[i + 1:]
+
+    def save(self, filename):
+        """
+        Write wire format PDUs to file.
+        """
+
+        with open(filename, "wb") as f:
+            f.write("".join(self))
+
+
+class PackedAXFRSet(PackedPDUSet, AXFRSet):
+    """
+    Compact form of AXFRSet.  All PDUs have the announce flag set.
+    """
+
+    @classmethod
+    def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None):
+        """
+        Parse ROAs and router certificates fetched (and validated!) by
+        rcynic to create a new PackedAXFRSet.
+        """
+
+        self = cls(version = version)
+        self.serial = rpki.rtr.channels.Timestamp.now()
+        self.extend(set(pdu.to_pdu() for pdu in cls._rcynic_pdus(rcynic_dir, version, scan_roas, scan_routercerts)))
+        self.sort()
+        return self
+
+    def save_axfr(self):
+        """
+        Write PackedAXFRSet to file with magic filename.
+        """
+
+        self.save(self.filename())
+
+    def diff(self, other):
+        """
+        Compute the PackedIXFRSet from another (older) PackedAXFRSet to
+        this one.
+        """
+
+        new = set(self)
+        old = set(other)
+        withdrawn = old - new
+        ixfr = PackedIXFRSet(version = self.version)
+        ixfr.from_serial = other.serial
+        ixfr.to_serial = self.serial
+        ixfr.extend(self.set_announce(pdu, 0) if pdu in withdrawn else pdu
+                    for pdu in sorted(withdrawn | (new - old)))
+        return ixfr
+
+    def save_ixfr(self, other):
+        """
+        Compare this PackedAXFRSet with an older one and write the
+        resulting IXFR to file with magic filename.
+        """
+
+        ixfr = self.diff(other)
+        ixfr.save_ixfr()
+        return ixfr
+
+    def show(self):
+        """
+        Print this PackedAXFRSet.
+        """
+
+        AXFRSet.load(self.filename()).show()
+
+
+class PackedIXFRSet(PackedPDUSet, IXFRSet):
+    """
+    Compact form of IXFRSet.
+    """
+
+    def changes(self):
+        """
+        Return a dict mapping the announced form of each PDU in this
+        IXFR to its announce flag.
+        """
+
+        return dict((self.set_announce(pdu, 1), self.get_announce(pdu)) for pdu in self)
+
+    def compose(self, other):
+        """
+        Compose this IXFR with the one following it, yielding the IXFR
+        from our starting serial to other's ending serial.  This only
+        costs as much as the two IXFRs, regardless of how big the full
+        table is.  Changes which cancel out (a PDU announced by one and
+        withdrawn by the other) drop out of the result.
+        """
+
+        assert self.version == other.version and self.to_serial == other.from_serial
+        changes = self.changes()
+        for pdu, announce in other.changes().iteritems():
+            if changes.get(pdu, announce) != announce:
+                del changes[pdu]
+            else:
+                changes[pdu] = announce
+        ixfr = self.__class__(version = self.version)
+        ixfr.from_serial = self.from_serial
+        ixfr.to_serial = other.to_serial
+        ixfr.extend(pdu if announce else self.set_announce(pdu, 0)
+                    for pdu, announce in sorted(changes.iteritems()))
+        return ixfr
+
+    def save_ixfr(self):
+        """
+        Write PackedIXFRSet to file with magic filename.
+        """
+
+        self.save(self.filename())
+
+    def show(self):
+        """
+        Print this PackedIXFRSet.
+        """
+
+        IXFRSet.load(self.filename()).show()
+
+
 def kick_all(serial):
     """
     Kick any existing server processes to wake them up.
@@ -525,14 +718,26 @@ def cronjob_main(args):
                 logging.debug("# Deleting old file %s, timestamp %s", f, t)
                 os.unlink(f)
 
-        pdus = rpki.rtr.generator.AXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
-        if pdus == rpki.rtr.generator.AXFRSet.load_current(version):
+        pdus = rpki.rtr.generator.PackedAXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
+        prev = rpki.rtr.generator.PackedAXFRSet.load_current(version)
+        if pdus == prev:
             logging.debug("# No change, new serial not needed")
             continue
         pdus.save_axfr()
+
+        # IXFRs from older serials are the IXFRs we wrote to the previous
+        # serial last time, composed with the change from there to here.
+        # Only fall back to loading an old AXFR if that IXFR is missing.
+
+        latest = None if prev is None else pdus.save_ixfr(prev)
         for axfr in glob.iglob("*.ax.v%d" % version):
-            if axfr != pdus.filename():
-                pdus.save_ixfr(rpki.rtr.generator.AXFRSet.load(axfr))
+            if axfr == pdus.filename() or (prev is not None and axfr == prev.filename()):
+                continue
+            ixfr = None if prev is None else "%d.ix.%s.v%d" % (prev.serial, axfr.split(".")[0], version)
+            if ixfr is not None and os.path.exists(ixfr):
+                rpki.rtr.generator.PackedIXFRSet.load(ixfr).compose(latest).save_ixfr()
+            else:
+                pdus.save_ixfr(rpki.rtr.generator.PackedAXFRSet.load(axfr))
         pdus.mark_current(args.force_zero_nonce)
 
         logging.debug("# New serial is %d (%s)", pdus.serial, pdus.serial)
@@ -23,6 +23,7 @@ Server implementation for the RPKI-RTR protocol (RFC 6810 et sequalia).
 
 import os
 import sys
+import mmap
 import errno
 import socket
 import signal
@@ -57,7 +58,7 @@ class PDU(rpki.rtr.pdus.PDU):
         fn2 = os.path.splitext(filename)[1]
         assert fn2.startswith(".v") and fn2[2:].isdigit() and int(fn2[2:]) == server.version
 
-        f = open(filename, "rb")
+        f = server.open_file(filename)
         server.push_pdu(CacheResponsePDU(version = server.version,
                                          nonce   = server.current_nonce))
         server.push_file(f)
@@ -159,7 +160,7 @@ class ErrorReportPDU(rpki.rtr.pdus.ErrorReportPDU):
         server.logger.error(self)
         if self.errno in self.fatal:
             server.logger.error("[Shutting down due to reported fatal protocol error]")
-            sys.exit(1)
+            server.fatal_error()
 
 
 def read_current(version):
@@ -193,6 +194,24 @@ def write_current(serial, nonce, version):
     os.rename(tmpfn, curfn)
 
 
+def map_file(filename):
+    """
+    Map an AXFR or IXFR file into memory, so that we can hand slices of
+    the page cache to the socket rather than copying the file through
+    Python strings.  Empty files (eg, an IXFR between identical sets)
+    can't be mapped, so we return an empty string for those.  Caller
+    should catch IOError.
+    """
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except mmap.error, e:
+            raise IOError(e)
+
+
 class FileProducer(object):
     """
     File-based producer object for asynchat.
@@ -206,6 +225,26 @@ class FileProducer(object):
         return self.handle.read(self.buffersize)
 
 
+class BufferProducer(object):
+    """
+    Producer object for asynchat which hands out slices of a string or
+    memory-mapped file without copying it, so that many sessions can
+    send the same AXFR or IXFR data at once.
+    """
+
+    def __init__(self, data, buffersize):
+        self.data = data
+        self.buffersize = buffersize
+        self.offset = 0
+
+    def more(self):
+        if self.offset >= len(self.data):
+            return ""
+        b = buffer(self.data, self.offset, self.buffersize)
+        self.offset += self.buffersize
+        return b
+
+
 class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
     """
     Kludge to deal with ssh's habit of sometimes (compile time option)
@@ -215,6 +254,9 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
     server's output to a different file descriptor.
     """
 
+    # AXFRs run to tens of megabytes, so write them in big chunks.
+    ac_out_buffer_size = 65536
+
     def __init__(self):
         """
         Set up stdout.
@@ -236,7 +278,7 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
         """
 
         try:
-            self.push_with_producer(FileProducer(f, self.ac_out_buffer_size))
+            self.push_with_producer(BufferProducer(f, self.ac_out_buffer_size))
         except OSError, e:
             if e.errno != errno.EAGAIN:
                 raise
@@ -299,6 +341,20 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
 
         return self.writer.push_file(f)
 
+    def open_file(self, filename):
+        """
+        Open an AXFR or IXFR file for push_file().  Caller should catch IOError.
+        """
+
+        return map_file(filename)
+
+    def fatal_error(self):
+        """
+        Shut down after a fatal protocol error.
+        """
+
+        sys.exit(1)
+
     def deliver_pdu(self, pdu):
         """
         Handle received PDU.
@@ -344,6 +400,140 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
             self.logger.debug("Cronjob kicked me but I see no serial change, ignoring")
 
 
+class SharedData(object):
+    """
+    State shared by all the sessions in a multiplexed server process:
+    current serial numbers and nonces, contents of the AXFR and IXFR
+    files that sessions have sent, and the set of live sessions.  We
+    read each of these once per serial number change, no matter how
+    many routers are connected, and a kick from the cronjob turns into
+    one notify per session.
+
+    This also stands in for a ServerChannel as far as KickmeChannel is
+    concerned.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.current = {}
+        self.files = {}
+        self.sessions = set()
+
+    def read_current(self, version):
+        if version not in self.current:
+            self.current[version] = read_current(version)
+        return self.current[version]
+
+    def read_file(self, filename):
+        if filename not in self.files:
+            self.files[filename] = map_file(filename)
+        return self.files[filename]
+
+    def notify(self, data = None):
+        """
+        Cronjob kicked us: forget what we know, then pass the kick along
+        to every session.
+        """
+
+        self.current.clear()
+        self.files.clear()
+        self.logger.debug("[Kicking %d sessions]", len(self.sessions))
+        for session in list(self.sessions):
+            session.notify(data)
+
+
+class MultiplexedServerChannel(ServerChannel):
+    """
+    Server protocol engine for one session on a TCP socket, in a
+    process which handles many sessions on a single asyncore loop.
+    Unlike the plain ServerChannel, a session ending or failing just
+    closes this channel rather than exiting the process.
+    """
+
+    ac_out_buffer_size = ServerWriteChannel.ac_out_buffer_size
+
+    def __init__(self, sock, shared, logger, refresh, retry, expire):
+        # Skip ServerChannel.__init__(), which wants stdin and stdout.
+        super(ServerChannel, self).__init__(root_pdu_class = PDU, sock = sock)  # pylint: disable=E1003
+        self.shared = shared
+        self.logger = logger
+        self.refresh = refresh
+        self.retry = retry
+        self.expire = expire
+        self.shared.sessions.add(self)
+        self.get_serial()
+        self.start_new_pdu()
+
+    def writable(self):
+        return rpki.rtr.channels.PDUChannel.writable(self)
+
+    def push(self, data):
+        return rpki.rtr.channels.PDUChannel.push(self, data)
+
+    def push_with_producer(self, producer):
+        return rpki.rtr.channels.PDUChannel.push_with_producer(self, producer)
+
+    def push_pdu(self, pdu):
+        return rpki.rtr.channels.PDUChannel.push_pdu(self, pdu)
+
+    def open_file(self, filename):
+        return self.shared.read_file(filename)
+
+    def push_file(self, f):
+        return self.push_with_producer(BufferProducer(f, self.ac_out_buffer_size))
+
+    def get_serial(self):
+        self.current_serial, self.current_nonce = self.shared.read_current(self.version)
+        return self.current_serial
+
+    def fatal_error(self):
+        self.close()
+
+    def close(self):
+        self.shared.sessions.discard(self)
+        rpki.rtr.channels.PDUChannel.close(self)
+
+    def handle_close(self):
+        self.logger.debug("[Session closed]")
+        self.close()
+
+    def handle_error(self):
+        self.logger.exception("[Unhandled exception, closing session]")
+        self.close()
+
+
+class ListenerChannel(asyncore.dispatcher, object):
+    """
+    asyncore dispatcher for a listening TCP socket, creating a
+    MultiplexedServerChannel for each incoming connection.
+    """
+
+    def __init__(self, sock, shared, args):
+        asyncore.dispatcher.__init__(self, sock)            # Old-style class
+        self.shared = shared
+        self.args = args
+
+    def handle_accept(self):
+        try:
+            s, ai = self.accept()
+        except TypeError:
+            return                      # Connection went away before we could accept it
+        if ":" in ai[0]:
+            tag = "/tcp/%s.%s" % ai[:2]
+        else:
+            tag = "/tcp/%s:%s" % ai[:2]
+        logger = logging.LoggerAdapter(logging.root, dict(connection = tag))
+        logger.debug("[Accepted connection]")
+        MultiplexedServerChannel(sock = s, shared = self.shared, logger = logger,
+                                 refresh = self.args.refresh, retry = self.args.retry, expire = self.args.expire)
+
+    def handle_error(self):
+        logging.exception("[Unhandled exception in listener]")
+
+    def log_info(self, msg, tag = "info"):
+        logging.info("asyncore: %s: %s", tag, msg)
+
+
 class KickmeChannel(asyncore.dispatcher, object):
     """
     asyncore dispatcher for the PF_UNIX socket that cronjob mode uses to
@@ -416,9 +606,8 @@ class KickmeChannel(asyncore.dispatcher, object):
         Handle errors caught by asyncore main loop.
         """
 
-        self.server.logger.exception("[Unhandled exception]")
-        self.server.logger.critical("[Exiting after unhandled exception]")
-        sys.exit(1)
+        self.server.logger.exception("[Unhandled exception, closing kickme socket]")
+        self.cleanup()
 
 
 def hostport_tag():
@@ -514,21 +703,10 @@ def listener_main(args):
 
     # server_main() handles args.rpki_rtr_dir.
 
-    listener = None
-    try:
-        listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
-    except:
-        if listener is not None:
-            listener.close()
-        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    try:
-        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    except AttributeError:
-        pass
-    listener.bind(("", args.port))
-    listener.listen(5)
+    if args.multiplex:
+        return multiplexed_listener_main(args)
+
+    listener = listen_socket(args.port)
     logging.debug("[Listening on port %s]", args.port)
     while True:
         try:
@@ -557,6 +735,65 @@ def listener_main(args):
                 break
 
 
+def listen_socket(port, backlog = 5):
+    """
+    Create a TCP socket listening on port, IPv6 if we can, else IPv4.
+    """
+
+    listener = None
+    try:
+        listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    except:
+        if listener is not None:
+            listener.close()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except AttributeError:
+        pass
+    listener.bind(("", port))
+    listener.listen(backlog)
+    return listener
+
+
+def multiplexed_listener_main(args):
+    """
+    Listener which handles all of its sessions in one process, on one
+    asyncore loop, rather than forking a server process per connection.
+    With --processes greater than one, we fork that many copies, each
+    with its own listening socket; SO_REUSEPORT lets the kernel spread
+    connections across them.
+    """
+
+    if args.rpki_rtr_dir:
+        try:
+            os.chdir(args.rpki_rtr_dir)
+        except OSError, e:
+            logging.error("[Couldn't chdir(%r), exiting: %s]", args.rpki_rtr_dir, e)
+            sys.exit(1)
+
+    for i in xrange(args.processes - 1):
+        pid = os.fork()
+        if pid == 0:
+            break
+        logging.debug("[Spawned listener %d]", pid)
+
+    kickme = None
+    try:
+        shared = SharedData(logger = logging.LoggerAdapter(logging.root, dict(connection = "/listener/%d" % os.getpid())))
+        listener = ListenerChannel(sock = listen_socket(args.port, 128), shared = shared, args = args)
+        logging.debug("[Listening on port %s]", args.port)
+        kickme = KickmeChannel(server = shared)
+        asyncore.loop(timeout = None)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        if kickme is not None:
+            kickme.cleanup()
+
+
 def argparse_setup(subparsers):
     """
     Set up argparse stuff for commands in this module.
@@ -591,5 +828,9 @@ def argparse_setup(subparsers):
     subparser.add_argument("--refresh", type = refresh, help = "override default refresh timer")
     subparser.add_argument("--retry",   type = retry,   help = "override default retry timer")
     subparser.add_argument("--expire",  type = expire,  help = "override default expire timer")
+    subparser.add_argument("--multiplex", action = "store_true",
+                           help = "handle all connections in one process rather than forking per connection")
+    subparser.add_argument("--processes", type = int, default = 1,
+                           help = "number of multiplexed listener processes to run")
     subparser.add_argument("port",      type = int,     help = "TCP port on which to listen")
     subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
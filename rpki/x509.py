@@ -37,6 +37,7 @@ import rpki.POW
 import base64
 import lxml.etree
 import os
+import sys
 import subprocess
 import email.mime.application
 import email.utils
@@ -1260,6 +1261,91 @@ class insecure_debug_only_rsa_key_generator(object):
         return v
 
 
+## @var rsa_key_pool
+# Pool of pre-generated RSA keypairs, if this process has set one up.
+
+rsa_key_pool = None
+
+class rsa_key_pool_manager(object):
+    """
+    Pool of pre-generated RSA keypairs, kept as one file per key in a
+    private directory so that the pool survives restarts.  A separate
+    worker process refills the directory to the high water mark
+    whenever it drops below the low water mark; RSA.generate() just
+    takes a key from the directory, falling back to generating one
+    itself if the pool has run dry.
+    """
+
+    poll_interval = 1
+
+    def __init__(self, dirname, low_water = 50, high_water = 200, keylength = 2048):
+        assert 0 <= low_water <= high_water
+        self.dirname = dirname
+        self.low_water = low_water
+        self.high_water = high_water
+        self.keylength = keylength
+        self.available = []
+        self.worker = None
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+
+    def keys(self):
+        return [fn for fn in os.listdir(self.dirname) if fn.endswith(".key")]
+
+    def start(self):
+        """
+        Start the worker process which refills the pool.
+        """
+
+        import multiprocessing
+        self.worker = multiprocessing.Process(target = self.refill_loop, args = (os.getpid(),), name = "rsa-key-pool")
+        self.worker.daemon = True
+        self.worker.start()
+        logger.debug("Started RSA key pool worker %d for %s", self.worker.pid, self.dirname)
+
+    def refill_loop(self, parent):
+        """
+        Worker process main loop.  Exits if our parent goes away.
+        """
+
+        keyno = 0
+        while os.getppid() == parent:
+            count = len(self.keys())
+            if count >= self.low_water:
+                time.sleep(self.poll_interval)
+                continue
+            logger.debug("RSA key pool %s down to %d keys, refilling", self.dirname, count)
+            while count < self.high_water and os.getppid() == parent:
+                der = rpki.POW.Asymmetric.generateRSA(self.keylength).derWritePrivate()
+                fn = os.path.join(self.dirname, "%d.%d.%d.key" % (os.getpid(), time.time(), keyno))
+                keyno += 1
+                fd = os.open(fn + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(der)
+                os.rename(fn + ".tmp", fn)
+                count += 1
+
+    def get(self):
+        """
+        Take a key from the pool.  Returns DER, or None if the pool is empty.
+        """
+
+        while True:
+            if not self.available:
+                self.available = self.keys()
+                if not self.available:
+                    logger.warning("RSA key pool %s is empty", self.dirname)
+                    return None
+            fn = os.path.join(self.dirname, self.available.pop())
+            try:
+                with open(fn, "rb") as f:
+                    der = f.read()
+                os.unlink(fn)
+                return der
+            except (IOError, OSError):
+                continue
+
+
 class PrivateKey(DER_object):
     """
     Class to hold a Public/Private key pair.
@@ -1408,8 +1494,11 @@ class RSA(PrivateKey):
             logger.debug("Generating new %d-bit RSA key", keylength)
         if generate_insecure_debug_only_rsa_key is not None:
             return cls(POW = generate_insecure_debug_only_rsa_key())
-        else:
-            return cls(POW = rpki.POW.Asymmetric.generateRSA(keylength))
+        if rsa_key_pool is not None and keylength == rsa_key_pool.keylength:
+            der = rsa_key_pool.get()
+            if der is not None:
+                return cls(DER = der)
+        return cls(POW = rpki.POW.Asymmetric.generateRSA(keylength))
 
 class ECDSA(PrivateKey):
     """
@@ -1838,14 +1927,19 @@ class SignedManifest(DER_CMS_object):
         return self.get_POW().getNextUpdate()
 
     @classmethod
-    def build(cls, serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs, version = 0):
+    def build(cls, serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs, version = 0,
+              names_and_hashes = ()):
         """
-        Build a signed manifest.
+        Build a signed manifest.  names_and_hashes lists entries for
+        which the caller already has the SHA-256 digest, so we needn't
+        hash the objects again.
         """
 
         filelist = []
         for name, obj in names_and_objs:
             filelist.append((name.rpartition("/")[2], sha256(obj.get_DER())))
+        for name, digest in names_and_hashes:
+            filelist.append((name.rpartition("/")[2], digest))
         filelist.sort(key = lambda x: x[0])
 
         obj = cls.POW_class()
@@ -2028,10 +2122,40 @@ class XML_CMS_object(Wrapped_CMS_object):
         self.set_content(msg)
         if self.check_outbound_schema:
             self.schema_check()
+        if crypto_executor is not None:
+            return self._wrap_done(crypto_executor.run(_xml_cms_sign, self._wrap_args(keypair, certs, crls)))
         self.sign(keypair, certs, crls)
+        return self._wrap_done(self.get_DER())
+
+    def wrap_async(self, msg, keypair, certs, crls = None):
+        """
+        Like .wrap(), but returns a tornado Future, and does the signing
+        in crypto_executor if we have one.
+        """
+
+        if crypto_executor is None:
+            return crypto_future(lambda: self.wrap(msg, keypair, certs, crls))
+        self.set_content(msg)
+        if self.check_outbound_schema:
+            self.schema_check()
+        return crypto_future(self._wrap_done, _xml_cms_sign, self._wrap_args(keypair, certs, crls))
+
+    def _wrap_args(self, keypair, certs, crls):
+        if isinstance(certs, X509):
+            certs = (certs,)
+        if crls is None:
+            crls = ()
+        elif isinstance(crls, CRL):
+            crls = (crls,)
+        return (self.__class__, self.encode(), keypair.get_DER(),
+                [x.get_DER() for x in certs], [c.get_DER() for c in crls])
+
+    def _wrap_done(self, der):
+        # pylint: disable=W0201
+        self.DER = der
         if self.dump_outbound_cms:
             self.dump_outbound_cms.dump(self)
-        return self.get_DER()
+        return der
 
     def unwrap(self, ta):
         """
@@ -2040,11 +2164,34 @@ class XML_CMS_object(Wrapped_CMS_object):
 
         if self.dump_inbound_cms:
             self.dump_inbound_cms.dump(self)
+        if crypto_executor is not None:
+            return self._unwrap_done(crypto_executor.run(_xml_cms_verify, self._unwrap_args(ta)))
         self.verify(ta)
         if self.check_inbound_schema:
             self.schema_check()
         return self.get_content()
 
+    def unwrap_async(self, ta):
+        """
+        Like .unwrap(), but returns a tornado Future, and does the
+        verification in crypto_executor if we have one.
+        """
+
+        if crypto_executor is None:
+            return crypto_future(lambda: self.unwrap(ta))
+        if self.dump_inbound_cms:
+            self.dump_inbound_cms.dump(self)
+        return crypto_future(self._unwrap_done, _xml_cms_verify, self._unwrap_args(ta))
+
+    def _unwrap_args(self, ta):
+        return (self.__class__, self.get_DER(), [x.get_DER() for x in X509.normalize_chain(ta)])
+
+    def _unwrap_done(self, xml):
+        self.decode(xml)
+        if self.check_inbound_schema:
+            self.schema_check()
+        return self.get_content()
+
     def check_replay(self, timestamp, *context):
         """
         Check CMS signing-time in this object against a recorded
@@ -2197,6 +2344,131 @@ class CRL(DER_object):
 
         return self.getThisUpdate()
 
+## @var crypto_executor
+# Pool of worker processes for CMS signing and verification, if this
+# process has set one up.
+
+crypto_executor = None
+
+class CryptoExecutor(object):
+    """
+    Pool of worker processes to run expensive CMS operations outside
+    the main process.  Everything crossing the process boundary is DER
+    or XML text, so the workers need no state of their own beyond the
+    class-level flags they inherit when we fork them, which means this
+    must be created after the configuration has been read.
+
+    multiprocessing in Python 2.7 has no error callback, so if anything
+    goes wrong outside _crypto_call() (arguments or results that won't
+    pickle, a worker dying) we'd never hear about it.  So we check that
+    the arguments pickle before handing them over, and give up on any
+    call that takes longer than timeout seconds.
+    """
+
+    def __init__(self, processes = None, timeout = 300):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(processes)
+        self.timeout = timeout
+
+    @staticmethod
+    def check_args(func, args):
+        """
+        Make sure func and args will survive the trip to a worker.
+        """
+
+        import cPickle
+        cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL)
+
+    def run(self, func, args):
+        """
+        Run func(*args) in a worker process and wait for the result.
+        """
+
+        import multiprocessing
+        self.check_args(func, args)
+        try:
+            return self.result(self.pool.apply_async(_crypto_call, (func, args)).get(self.timeout))
+        except multiprocessing.TimeoutError:
+            raise rpki.exceptions.CryptoTimeout
+
+    def submit(self, func, args, callback):
+        """
+        Run func(*args) in a worker process, then call callback with the
+        (opaque) result on the current tornado IOLoop.  The callback is
+        called exactly once, with a failure result if the call couldn't
+        be made or timed out.
+        """
+
+        import tornado.ioloop
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        try:
+            self.check_args(func, args)
+        except Exception, e:
+            ioloop.add_callback(callback, (False, (e.__class__, e.args)))
+            return
+
+        done = []
+
+        def finish(result):
+            if not done:
+                done.append(True)
+                ioloop.remove_timeout(timeout)
+                callback(result)
+
+        timeout = ioloop.call_later(self.timeout, finish, (False, (rpki.exceptions.CryptoTimeout, ())))
+        self.pool.apply_async(_crypto_call, (func, args),
+                              callback = lambda result: ioloop.add_callback(finish, result))
+
+    @staticmethod
+    def result(result):
+        """
+        Unpack the result of a worker call, reraising any exception.
+        """
+
+        ok, value = result
+        if ok:
+            return value
+        exc_class, exc_args = value
+        raise exc_class(*exc_args)
+
+def crypto_future(finish, func = None, args = ()):
+    """
+    Return a tornado Future for the result of finish().  If func is
+    given, we first run func(*args) in crypto_executor, then pass its
+    result to finish().
+    """
+
+    import tornado.concurrent
+    future = tornado.concurrent.Future()
+
+    def resolve(thunk):
+        try:
+            future.set_result(thunk())
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+
+    if func is None:
+        resolve(finish)
+    else:
+        crypto_executor.submit(func, args, lambda result: resolve(lambda: finish(CryptoExecutor.result(result))))
+    return future
+
+def _crypto_call(func, args):
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, (e.__class__, e.args)
+
+def _xml_cms_sign(cls, xml, keypair, certs, crls):
+    self = cls()
+    self.decode(xml)
+    self.sign(PrivateKey(DER = keypair), [X509(DER = x) for x in certs], [CRL(DER = c) for c in crls])
+    return self.get_DER()
+
+def _xml_cms_verify(cls, der, ta):
+    return CMS_object.verify(cls(DER = der), tuple(X509(DER = x) for x in ta))
+
 ## @var uri_dispatch_map
 # Map of known URI filename extensions and corresponding classes.
 